@@ -1,4 +1,5 @@
 import numpy as np
+import time
 import matplotlib.pyplot as plt
 import scipy as sc
 import cv2
@@ -10,6 +11,13 @@ from skimage.restoration import unwrap_phase
 from skimage.filters import threshold_otsu
 from skimage import morphology
 from kneed import KneeLocator
+from itertools import repeat
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from multiprocessing import shared_memory
+
+from settings import TRANSFER_CACHE_SIZE, TILED_MEMORY_BUDGET, MASK_CACHE_SIZE
+from fft_backend import fft2, ifft2, fftshift, ifftshift, get_backend, init_worker
+from bounded_cache import BoundedCache
 
 '''Semi-Heuristic Phase Compensation function
 
@@ -39,6 +47,14 @@ from kneed import KneeLocator
       according to the cartessian regions of a plane.
       step: value of the step for each iteration of the search
       G: value of the depth of the search
+      workers: number of threads evaluating the candidates of each search step
+      carrier: 'search' for the semi-heuristic search, 'gaussian', 'parabolic' or
+      'dft' for the sub-pixel peak of the filtered spectrum
+      upsample: refinement factor of the 'dft' estimator
+      return_carrier: also return the carrier found, its tilt and its metric
+      window: size of the spectrum window around the +1 order to reconstruct, None
+      for the full size
+      full_size: interpolate the compensated window back to the hologram size
 
     Outputs:
       phase: the phase reconstruction of the hologram
@@ -71,6 +87,30 @@ def read(filename:str, path:str = '') -> np.ndarray:
 
 
 
+# Quadrant slices of filter_mask, one per (N, M, region)
+_mask_cache = BoundedCache(MASK_CACHE_SIZE)
+
+def quadrant_slices(N:int, M:int, region:int) -> tuple[slice, slice]:
+    '''Rows and columns of the spectrum kept by filter_mask for a region (1-4).'''
+    key = (N, M, region)
+    quadrant = _mask_cache.get(key)
+    if quadrant is not None:
+        return quadrant
+
+    top, bottom = slice(0, round(N/2-(N*0.1))), slice(round(N/2+(N*0.1)), N)
+    left, right = slice(0, round(M/2-(M*0.1))), slice(round(M/2+(M*0.1)), M)
+
+    if region==1:
+        quadrant = (top, right) # 1st quadrant
+    elif region==2:
+        quadrant = (top, left) # 2nd quadrant
+    elif region==3:
+        quadrant = (bottom, left) # 3rd quadrant
+    else:
+        quadrant = (bottom, right) # 4th quadrant
+
+    return _mask_cache.put(key, quadrant)
+
 def filter_mask(holo:np.ndarray,
                 N:int,
                 M:int,
@@ -78,38 +118,33 @@ def filter_mask(holo:np.ndarray,
     '''Applies broad filter to eliminate unwanted dc signal.
 
     returns the filtered ft of the hologram and the index of its max value.
+    Only the quadrant of the region (see quadrant_slices) is copied and searched.
     '''
 
     #Calculate the Fourier Transform of the hologram and shift the
     #zero-frequency component to the center
-    ft_holo = np.fft.fftshift(np.fft.fft2(np.fft.fftshift(holo)))
+    ft_holo = fftshift(fft2(fftshift(holo)))
 
+    rows, cols = quadrant_slices(N, M, region)
 
-    filter_ = np.zeros((N, M))
+    # Keep the desired region, same dtype as the product with a float64 mask
+    ft_filtered_holo = np.zeros((N, M), dtype=np.result_type(ft_holo, np.float64))
+    quadrant = ft_filtered_holo[rows, cols]
+    quadrant[...] = ft_holo[rows, cols]
 
-    # Create a filter mask for the desired region
-    if region==1:
-        filter_[0:round(N/2-(N*0.1)),round(M/2+(M*0.1)):M] = 1; # 1st quadrant
-    elif region==2:
-        filter_[0:round(N/2-(N*0.1)),0:round(M/2-(M*0.1))] = 1; # 2nd quadrant
-    elif region==3:
-        filter_[round(N/2+(N*0.1)):N,0:round(M/2-(M*0.1))] = 1; # 3rd quadrant
-    else:
-        filter_[round(N/2+(N*0.1)):N,round(M/2+(M*0.1)):M] = 1; # 4th quadrant
+    # Find the maximum value in the filtered spectrum, |.|^2 has the same argmax as
+    # the log of the spectrum
+    power = quadrant.real**2
+    power += quadrant.imag**2
+    row, col = np.unravel_index(np.argmax(power), power.shape)
 
-    # Apply the filter to the Fourier Transform of the hologram
-    ft_filtered_holo = ft_holo * filter_
-
-    filtered_spect = np.log(np.abs(ft_filtered_holo)**2+1)
-    # Find the maximum value in the filtered spectrum
-
-    idx = np.argmax(filtered_spect, axis=None)
+    idx = np.ravel_multi_index((row + rows.start, col + cols.start), (N, M))
     return ft_filtered_holo, idx
 
 
-def normalize(x: np.ndarray, scale: float) -> np.ndarray:
+def normalize(x: np.ndarray, scale: float, dtype=np.float64) -> np.ndarray:
     '''Normalize every value of an array to the 0-scale interval.'''
-    x = x.astype(np.float64)
+    x = x.astype(dtype)
 
     min_val = np.min(x)
 
@@ -122,6 +157,23 @@ def normalize(x: np.ndarray, scale: float) -> np.ndarray:
     return normalized_image
 
 
+def precision_dtypes(precision: str) -> tuple:
+    '''Returns the (real, complex) dtypes of a precision setting, 'float32' or 'float64'.'''
+    if precision == 'float32':
+        return np.float32, np.complex64
+    elif precision == 'float64':
+        return np.float64, np.complex128
+
+    raise ValueError(f'Unknown precision: {precision}')
+
+
+def complex_dtype(dtype) -> type:
+    '''Returns the complex dtype matching an array's precision, single precision stays single.'''
+    if np.dtype(dtype) in (np.float32, np.complex64):
+        return np.complex64
+    return np.complex128
+
+
 def metric( holo_rec:np.ndarray,
             fx_0:int,
             fy_0:int,
@@ -161,79 +213,186 @@ def metric( holo_rec:np.ndarray,
 
     return num
 
-def compensate(hologram:np.ndarray,
-               dx:float, dy:float,
-               lambda_:float,
-               region:int,
-               step:float = 0.5,
-               depth:int = 3) -> np.ndarray:
-    '''Filters and compensates the input hologram.'''
-    N, M = np.shape(hologram)[:2]
+def separable_metrics(phase0:np.ndarray,
+                      zeros:np.ndarray,
+                      fx_0:int,
+                      fy_0:int,
+                      candidates:list,
+                      lambda_:float,
+                      M:int,
+                      N:int,
+                      dx:float,
+                      dy:float,
+                      mm:np.ndarray,
+                      nn:np.ndarray,
+                      k:float,
+                      batch_size:int = 4) -> np.ndarray:
+    '''Values of metric for a list of (fy_tmp, fx_tmp) candidates, exploiting that the
+    reference wave is separable.
+
+    The phase of holo_rec*ref is the phase of holo_rec (phase0) plus the phase of the
+    reference, which is the sum of a row and a column ramp, wrapped to [-pi, pi). So
+    no complex exponential or arctangent is evaluated per candidate. zeros marks the
+    pixels where holo_rec is 0, whose phase is 0 whatever the reference.
+
+    The values are not bit-identical to metric: the phase is wrapped with a floor
+    instead of np.angle and thresholded as x-min > 0.1*span instead of through
+    normalize, so pixels within rounding of the wrap or of the threshold can be
+    counted differently (a count or two on a few candidates). This can only change
+    the winner of the search between near-ties.
+
+    Consecutive candidates sharing fy_tmp share phase0 plus their column ramp and are
+    evaluated batch_size at a time as one (batch, N, M) broadcast. The arithmetic is
+    done in the dtype of phase0, float32 phases (single precision holograms) take
+    about half the time. Every candidate still needs a full pass over the image
+    (about 30 ms per candidate at 1080p in double precision, 2 s for a default
+    search), the threshold depends on the extremes of the whole wrapped phase so it
+    can not be made cheaper without changing the result.
+    '''
+    dtype = phase0.dtype
+    two_pi = dtype.type(2*np.pi)
+
+    sums = np.zeros(len(candidates), dtype=int)
+
+    i = 0
+    while i < len(candidates):
+        # Run of candidates with the same fy_tmp, at most batch_size long
+        fy_tmp = candidates[i][0]
+        j = i + 1
+        while j < len(candidates) and j - i < batch_size and candidates[j][0] == fy_tmp:
+            j += 1
+        fx_tmps = np.array([fx_tmp for _, fx_tmp in candidates[i:j]])
+
+        #Calculate the angles for the compensation wave
+        theta_x = np.arcsin((fx_0 - fx_tmps) * lambda_ / (M * dx))
+        theta_y = np.arcsin((fy_0 - fy_tmp) * lambda_ / (N * dy))
+
+        #Phase of the reference wave along each axis, shifted by pi for the wrapping
+        rows = (k * np.sin(theta_x)[:, None] * mm[None, :] * dx + np.pi).astype(dtype)
+        col = (k * np.sin(theta_y) * nn * dy).astype(dtype)
+
+        #Phase of the compensated reconstruction, wrapped
+        phase = (phase0 + col[:, None])[None] + rows[:, None, :]
+        phase -= two_pi*np.floor(phase*(1/two_pi))
+        phase -= dtype.type(np.pi)
+
+        if zeros is not None:
+            phase[:, zeros] = 0
+
+        # Threshold of the normalized phase (binarization), as in metric
+        min_val = np.min(phase, axis=(1, 2))
+        span = np.max(phase, axis=(1, 2)) - min_val
+        span[span==0] = 1
+
+        sums[i:j] = np.count_nonzero(phase - min_val[:, None, None] > (0.1*span)[:, None, None],
+                                     axis=(1, 2))
+        i = j
+
+    return sums
+
+def _peak_offset(minus:float, center:float, plus:float) -> float:
+    '''Vertex of the parabola through three equally spaced samples, relative to the center one.'''
+    denominator = minus - 2*center + plus
+    if denominator == 0:
+        return 0.0
+    return float(np.clip(0.5*(minus - plus)/denominator, -0.5, 0.5))
+
+def carrier_peak(ft_filtered_holo:np.ndarray,
+                 idx:int,
+                 hologram:np.ndarray = None,
+                 method:str = 'gaussian',
+                 upsample:int = 10) -> tuple[float, float]:
+    '''Sub-pixel position (fy, fx) of the maximum of the filtered spectrum of filter_mask.
+
+    'parabolic' and 'gaussian' fit a parabola to the magnitude, or its logarithm, of
+    the peak and its two neighbours along each axis. 'dft' evaluates the spectrum of
+    the hologram on a grid upsample times finer within one pixel of the peak with a
+    matrix product DFT, which costs O(upsample*N*M) but no full size transform.
+    '''
+    N, M = np.shape(ft_filtered_holo)[:2]
+    fy, fx = np.unravel_index(idx, [N, M])
 
-    mm, nn = np.linspace(-M/2, M/2-1, M), np.linspace(-N/2, N/2-1, N)
+    if method in ('parabolic', 'gaussian'):
+        # Magnitude of the peak and its neighbours, the borders are not fitted
+        rows = np.abs(ft_filtered_holo[max(fy-1, 0):fy+2, fx])
+        cols = np.abs(ft_filtered_holo[fy, max(fx-1, 0):fx+2])
 
+        if method == 'gaussian':
+            tiny = np.finfo(np.float64).tiny
+            rows, cols = np.log(np.maximum(rows, tiny)), np.log(np.maximum(cols, tiny))
 
-    m, n = np.meshgrid(mm, nn)
+        dy = _peak_offset(*rows) if len(rows) == 3 else 0.0
+        dx = _peak_offset(*cols) if len(cols) == 3 else 0.0
 
-    ft_filtered_holo, idx = filter_mask(hologram, N, M, region)
+        return fy + dy, fx + dx
 
-    # Define wavenumber
-    k = 2 * np.pi / lambda_
+    elif method == 'dft':
+        if hologram is None:
+            raise ValueError('The dft carrier estimator needs the hologram')
 
-    # Calculate the center frequencies for fx and fy
-    fx_0 = M/2
-    fy_0 = N/2
+        offsets = np.arange(-upsample, upsample+1) / upsample
 
-    # Get the maximum values of fx and fy
-    fy_max, fx_max = np.unravel_index(idx, [N, M])
+        # Same centered coordinates as the fftshift(fft2(fftshift(holo))) of filter_mask
+        x = np.arange(M) - M/2
+        y = np.arange(N) - N/2
+        kernel_x = np.exp(-2j*np.pi*np.outer(fx - M/2 + offsets, x)/M)
+        kernel_y = np.exp(-2j*np.pi*np.outer(fy - N/2 + offsets, y)/N)
 
+        spectrum = np.abs(kernel_y @ np.asarray(hologram, dtype=np.float64) @ kernel_x.T)
+        iy, ix = np.unravel_index(np.argmax(spectrum), spectrum.shape)
 
-    # Define the step size for the search
-    step = step
+        return fy + offsets[iy], fx + offsets[ix]
 
-    # Initialize variables for the search
-    j = 0
+    raise ValueError(f'Unknown carrier estimator: {method}')
 
-    # Calculate the Inverse Fourier Transform of the filtered hologram
-    holo_rec = np.fft.fftshift(np.fft.ifft2(np.fft.fftshift(ft_filtered_holo)))
+def carrier_search(evaluate,
+                   fx:float,
+                   fy:float,
+                   step:float = 0.5,
+                   depth:int = 3) -> tuple[float, float, int]:
+    '''Semi-heuristic search of the carrier maximizing a metric.
+
+    evaluate takes a list of (fy, fx) candidates and returns their metrics.
 
+    Starting at (fx, fy), scans a grid of 2*depth steps per axis and recenters on its
+    best candidate, shrinking the grid by one step per iteration until the center does
+    not move. Returns (fy, fx, metric) of the carrier found.
+    '''
     # Define the search range (G)
     G = depth
 
     # Initialize flag for the search loop
     fin = 0
 
-    # Set initial values for fx and fy
-    fx = fx_max
-    fy = fy_max
-
     # Initialize temporary search range
     G_temp = G
 
+    # The start stays the carrier if no candidate has a positive metric
+    x_max_out, y_max_out, metric_out = fx, fy, 0
+
     # Loop to find the optimal fx and fy values
     while fin == 0:
-        i = 0
-        j = j + 1
 
         # Initialize the maximum sum (for thresholding)
         suma_maxima=0
 
-        # Nested loops for searching in the range of fx and fy
-        for fy_tmp in np.arange(fy-step*G_temp, fy+step*G_temp, step):
-            for  fx_tmp in np.arange(fx-step*G_temp, fx+step*G_temp, step):
+        # Every fx and fy in the search range, in the order of the nested loops
+        candidates = [(fy_tmp, fx_tmp)
+                      for fy_tmp in np.arange(fy-step*G_temp, fy+step*G_temp, step)
+                      for fx_tmp in np.arange(fx-step*G_temp, fx+step*G_temp, step)]
 
-                i = i+1
+        # Calculate the metric for every candidate at once
+        sums = evaluate(candidates)
 
-                # Calculate the metric for the current fx and fy
-                suma = metric(holo_rec, fx_0, fy_0, fx_tmp, fy_tmp,
-                              lambda_, M, N , dx, dy, m, n, k)
+        for (fy_tmp, fx_tmp), suma in zip(candidates, sums):
 
-                # Update maximum sum and corresponding fx and fy if
-                # current sum is greater than the previous maximum
-                if suma > suma_maxima:
-                    x_max_out = fx_tmp
-                    y_max_out = fy_tmp
-                    suma_maxima = suma
+            # Update maximum sum and corresponding fx and fy if
+            # current sum is greater than the previous maximum
+            if suma > suma_maxima:
+                x_max_out = fx_tmp
+                y_max_out = fy_tmp
+                suma_maxima = suma
+                metric_out = suma
 
         # Update the temporary search range
         G_temp = G_temp - 1
@@ -247,6 +406,133 @@ def compensate(hologram:np.ndarray,
         fx = x_max_out
         fy = y_max_out
 
+    return y_max_out, x_max_out, metric_out
+
+def fast_window(size:int) -> int:
+    '''Smallest even length of at least size with a fast FFT.'''
+    size = sc.fft.next_fast_len(max(int(size), 2))
+    while size % 2:
+        size = sc.fft.next_fast_len(size+1)
+    return size
+
+def compensate(hologram:np.ndarray,
+               dx:float, dy:float,
+               lambda_:float,
+               region:int,
+               step:float = 0.5,
+               depth:int = 3,
+               workers:int = 1,
+               carrier:str = 'search',
+               upsample:int = 10,
+               return_carrier:bool = False,
+               start:tuple = None,
+               window = None,
+               full_size:bool = False) -> np.ndarray:
+    '''Filters and compensates the input hologram.
+
+    With carrier='search' the carrier is found by the semi-heuristic search, whose
+    candidates are evaluated in batches with separable_metrics, in a pool of workers
+    threads if workers > 1, starting from the spectrum peak or from the (fy, fx) carrier start.
+    With 'gaussian', 'parabolic' or 'dft' it is the sub-pixel peak of the
+    filtered spectrum given by carrier_peak.
+
+    If window is given (an int or a (rows, cols) size no larger than the hologram,
+    rounded up to fast_window), only a window of the spectrum centered on the +1 order
+    is inverse transformed, giving a field of that size with a pitch of dx*M/cols,
+    dy*N/rows and the amplitude of the full size field. With full_size the compensated
+    window is interpolated back to the hologram size for display.
+
+    If return_carrier is True, returns (field, carrier) where carrier holds the
+    estimator, fx, fy, the tilt angles theta_x, theta_y (in hologram coordinates) and
+    the metric at that carrier.
+    '''
+    if carrier not in ('search', 'gaussian', 'parabolic', 'dft'):
+        raise ValueError(f'Unknown carrier estimator: {carrier}')
+
+    N, M = np.shape(hologram)[:2]
+    N_holo, M_holo, dx_holo, dy_holo = N, M, dx, dy
+
+    ft_filtered_holo, idx = filter_mask(hologram, N, M, region)
+
+    # Define wavenumber
+    k = 2 * np.pi / lambda_
+
+    # Get the maximum values of fx and fy
+    fy_max, fx_max = np.unravel_index(idx, [N, M])
+
+    if carrier != 'search':
+        # Sub-pixel position of the +1 order peak, no search
+        start = carrier_peak(ft_filtered_holo, idx, hologram,
+                             method=carrier, upsample=upsample)
+
+    # Position of the first row and column of the field in the hologram spectrum
+    y_offset, x_offset = 0, 0
+
+    if window is not None:
+        rows, cols = (window, window) if np.isscalar(window) else window
+        if rows > N or cols > M:
+            raise ValueError(f'The window {rows}x{cols} is larger than the hologram {N}x{M}')
+
+        # Rounded up to a fast length, but never past the hologram size
+        rows, cols = min(fast_window(rows), N), min(fast_window(cols), M)
+
+        # Recenter the +1 order in a rows x cols window of the spectrum
+        y_offset, x_offset = fy_max - rows//2, fx_max - cols//2
+        ft_filtered_holo = ft_filtered_holo[np.ix_((y_offset + np.arange(rows)) % N,
+                                                   (x_offset + np.arange(cols)) % M)]
+
+        # The window keeps the frequency sampling, so the pitch grows
+        dx, dy = dx*M/cols, dy*N/rows
+        N, M = rows, cols
+        fy_max, fx_max = rows//2, cols//2
+
+    if start is not None:
+        start = (start[0] - y_offset, start[1] - x_offset)
+
+    mm, nn = np.linspace(-M/2, M/2-1, M), np.linspace(-N/2, N/2-1, N)
+
+    m, n = np.meshgrid(mm, nn)
+
+    # Calculate the center frequencies for fx and fy
+    fx_0 = M/2
+    fy_0 = N/2
+
+    # Calculate the Inverse Fourier Transform of the filtered hologram
+    holo_rec = fftshift(ifft2(fftshift(ft_filtered_holo)))
+
+    # Phase of the reconstruction, shared by every candidate of the search
+    # (in single precision for float32 holograms, see separable_metrics)
+    if carrier == 'search' or return_carrier:
+        phase_dtype = np.float32 if np.asarray(hologram).dtype == np.float32 else np.float64
+        phase0 = np.angle(holo_rec).astype(phase_dtype, copy=False)
+        zeros = holo_rec == 0
+        zeros = zeros if np.any(zeros) else None
+
+    executor = ThreadPoolExecutor(max_workers=workers) if workers > 1 and carrier == 'search' else None
+
+    def metrics(candidates):
+        return separable_metrics(phase0, zeros, fx_0, fy_0, candidates,
+                                 lambda_, M, N, dx, dy, mm, nn, k)
+
+    def evaluate(candidates):
+        # One batch per row of the candidate grid, spread over the workers
+        per_row = max(int(round(np.sqrt(len(candidates)))), 1)
+        batches = [candidates[i:i+per_row] for i in range(0, len(candidates), per_row)]
+        sums = executor.map(metrics, batches) if executor else map(metrics, batches)
+        return np.concatenate([np.zeros(0, dtype=int), *sums])
+
+    if carrier == 'search':
+        # Start from the spectrum peak, or from the given carrier
+        fy, fx = (fy_max, fx_max) if start is None else start
+
+        y_max_out, x_max_out, suma_maxima = carrier_search(evaluate, fx, fy, step, depth)
+
+        if executor:
+            executor.shutdown()
+
+    else:
+        y_max_out, x_max_out = start
+        suma_maxima = metrics([(y_max_out, x_max_out)])[0] if return_carrier else None
 
     # Calculate the angles for the compensation wave
     theta_x = np.arcsin((fx_0 - x_max_out) * lambda_ / (M * dx))
@@ -258,10 +544,93 @@ def compensate(hologram:np.ndarray,
     # Apply the reference wave to the hologram reconstruction
     holo_rec2 = holo_rec * ref
 
+    if window is not None and full_size:
+        # Zero padded spectrum of the window, whose inverse transform divides by N*M
+        # like the full size reconstruction, so the amplitude is kept
+        padded = np.zeros((N_holo, M_holo), dtype=holo_rec2.dtype)
+        r0, c0 = N_holo//2 - N//2, M_holo//2 - M//2
+        padded[r0:r0+N, c0:c0+M] = fftshift(fft2(fftshift(holo_rec2)))
+        holo_rec2 = fftshift(ifft2(fftshift(padded)))
+    elif window is not None:
+        # ifft2 of the window divides by rows*cols instead of N*M
+        holo_rec2 *= N*M/(N_holo*M_holo)
+
+    if return_carrier:
+        x_max_out, y_max_out = x_max_out + x_offset, y_max_out + y_offset
+        return holo_rec2, {'estimator': carrier,
+                           'fx': x_max_out,
+                           'fy': y_max_out,
+                           'theta_x': np.arcsin((M_holo/2 - x_max_out) * lambda_ / (M_holo * dx_holo)),
+                           'theta_y': np.arcsin((N_holo/2 - y_max_out) * lambda_ / (N_holo * dy_holo)),
+                           'metric': suma_maxima}
 
     return holo_rec2
 
 
+class CarrierTracker:
+    '''Compensates consecutive off-axis frames, warm-starting the carrier search.
+
+    The first frame (or a frame of a new size) runs the full compensate search of
+    depth steps. Each following frame only searches radius steps around the last
+    carrier, and falls back to the full search if the metric of the carrier found
+    drops below tolerance times the metric of the last full search. window is passed
+    to compensate.
+
+        tracker = CarrierTracker(dxy, dxy, wavelength, region=1)
+        for frame in frames:
+            field = tracker(frame)
+    '''
+
+    def __init__(self, dx:float, dy:float, lambda_:float, region:int,
+                 step:float = 0.5, depth:int = 3, radius:int = 2,
+                 tolerance:float = 0.95, workers:int = 1, window = None):
+        self.dx = dx
+        self.dy = dy
+        self.lambda_ = lambda_
+        self.region = region
+        self.step = step
+        self.depth = depth
+        self.radius = radius
+        self.tolerance = tolerance
+        self.workers = workers
+        self.window = window
+
+        self.reset()
+
+    def reset(self):
+        '''Forgets the carrier, the next frame runs the full search.'''
+        self.shape = None
+        self.carrier = None
+        self.reference_metric = None
+        self.full_searches = 0
+
+    def _compensate(self, hologram, depth, start):
+        return compensate(hologram, self.dx, self.dy, self.lambda_, self.region,
+                          step=self.step, depth=depth, workers=self.workers,
+                          return_carrier=True, start=start, window=self.window)
+
+    def __call__(self, hologram:np.ndarray) -> np.ndarray:
+        '''Compensated field of the frame, the carrier found is kept in self.carrier.'''
+        shape = np.shape(hologram)[:2]
+
+        if self.carrier is not None and shape == self.shape:
+            start = (self.carrier['fy'], self.carrier['fx'])
+            field, carrier = self._compensate(hologram, self.radius, start)
+
+            if carrier['metric'] >= self.tolerance*self.reference_metric:
+                self.carrier = carrier
+                return field
+
+        field, carrier = self._compensate(hologram, self.depth, None)
+
+        self.shape = shape
+        self.carrier = carrier
+        self.reference_metric = carrier['metric']
+        self.full_searches += 1
+
+        return field
+
+
 def save(hologram:np.ndarray,
          outname:str, path:str = '',
          ext:str = 'bmp',
@@ -293,15 +662,13 @@ def save(hologram:np.ndarray,
 ######################################################################################
 '''The rest of this code containts utility functions from my previous project'''
 
-# Function to propagate an optical field using the Angular Spectrum approach
-def propagate(field, z, wavelength, dx, dy, scale_factor=1):
-    # Inputs:
-    # field - complex field
-    # wavelength - wavelength
-    # z - propagation distance
-    # dxy - sampling pitches
-    field = np.array(field)
-    M, N = field.shape
+# The angular spectrum filter is a circular convolution, which commutes with the
+# fftshift of the input and the ifftshift of the output, so both shifts cancel and only
+# the kernel has to be moved to FFT order (once, when it is built). The propagation is
+# then just fft2 -> multiply -> ifft2, with the same result as the centered version.
+def _kernel_root(shape, wavelength, dx, dy):
+    '''Square root of the angular spectrum kernel in FFT order, independent of z.'''
+    M, N = shape
     x = np.arange(0, N, 1)  # array x
     y = np.arange(0, M, 1)  # array y
     X, Y = np.meshgrid(x - (N / 2), y - (M / 2), indexing='xy')
@@ -309,20 +676,225 @@ def propagate(field, z, wavelength, dx, dy, scale_factor=1):
     dfx = 1 / (dx * N)
     dfy = 1 / (dy * M)
 
-    field_spec = np.fft.fftshift(field)
-    field_spec = np.fft.fft2(field_spec)
-    field_spec = np.fft.fftshift(field_spec)
-
     kernel = np.power(1 / wavelength, 2) - (np.power(X * dfx, 2) + np.power(Y * dfy, 2)) + 0j
-    phase = np.exp(1j * z * scale_factor * 2 * np.pi * np.sqrt(kernel))
 
-    tmp = field_spec * phase
-    out = np.fft.ifftshift(tmp)
-    out = np.fft.ifft2(out)
-    out = np.fft.ifftshift(out)
+    return ifftshift(np.sqrt(kernel))
+
+def _kernel_phase(root, z, scale_factor=1, dtype=np.complex128):
+    '''Transfer function of distance z from the root of _kernel_root, in dtype.
+
+    z may be an array broadcasting against root, e.g. (n, 1, 1) for a kernel per image.
+    '''
+    return np.exp(1j * z * scale_factor * 2 * np.pi * root).astype(dtype, copy=False)
+
+# Transfer functions of the angular spectrum method, cached by geometry. In the live
+# reconstruction the shape, wavelength, pitch and distance rarely change between frames,
+# so rebuilding the kernel on every call is wasted work. ang_spectrum_kernel of
+# kreuzer_functions keeps its kernels here too.
+transfer_cache = BoundedCache(TRANSFER_CACHE_SIZE)
+
+def transfer_function(shape, z, wavelength, dx, dy, scale_factor=1, dtype=np.complex128, cache=True):
+    '''Returns the angular spectrum transfer function (in FFT order) for the given geometry.
+
+    Results are kept in a bounded LRU cache keyed by shape, z, wavelength, pitches, scale
+    factor and dtype (see bounded_cache), so the returned array is read-only. With
+    cache=False a new kernel is built and not stored, for one-off distances.
+    '''
+    key = (tuple(shape), float(z), float(wavelength), float(dx), float(dy), float(scale_factor),
+           np.dtype(dtype).str)
+
+    phase = transfer_cache.get(key) if cache else None
+    if phase is not None:
+        return phase
+
+    # Always evaluated in double precision, then stored in the requested one
+    root = _kernel_root(shape, wavelength, dx, dy)
+    phase = _kernel_phase(root, z, scale_factor, dtype)
+
+    if not cache:
+        phase.setflags(write=False)
+        return phase
+
+    return transfer_cache.put(key, phase)
+
+def transfer_cache_info() -> dict:
+    '''Returns the hit/miss counters and current size of the transfer function cache.'''
+    return transfer_cache.info()
+
+def clear_transfer_cache(max_size: int = None) -> None:
+    '''Empties the transfer function cache and resets its counters.
+
+    If max_size is given the cache bound is changed as well, 0 disables caching.
+    '''
+    transfer_cache.clear(max_size)
+
+# Spectrum of a field, can be propagated to any number of distances
+def field_spectrum(field):
+    '''Returns the angular spectrum of a field in FFT order (not centered).
+
+    The result can be reused by propagate_spectrum and propagate_many for every
+    propagation of the same field, fftshift it to get the centered spectrum.
+    '''
+    return fft2(np.asarray(field))
+
+# Propagates an already transformed field (see field_spectrum)
+def propagate_spectrum(field_spec, z, wavelength, dx, dy, scale_factor=1, cache=True):
+    '''Propagates a spectrum (in FFT order) a distance z, costs one inverse FFT.'''
+    phase = transfer_function(field_spec.shape, z, wavelength, dx, dy, scale_factor,
+                              complex_dtype(field_spec.dtype), cache)
+
+    return ifft2(field_spec * phase, overwrite_x=True)
+
+# Function to propagate an optical field using the Angular Spectrum approach
+def propagate(field, z, wavelength, dx, dy, scale_factor=1, out=None):
+    # Inputs:
+    # field - complex field
+    # wavelength - wavelength
+    # z - propagation distance
+    # dxy - sampling pitches
+    # out - optional complex array of the same shape to write the result to, the
+    # transforms are done in place on it when the FFT backend allows it
+    # Single precision fields (float32/complex64) are propagated in complex64
+    field = np.asarray(field)
+    phase = transfer_function(field.shape, z, wavelength, dx, dy, scale_factor,
+                              complex_dtype(field.dtype))
+
+    if out is None:
+        field_spec = fft2(field)
+        field_spec *= phase
+        return ifft2(field_spec, overwrite_x=True)
+
+    out[...] = field
+    field_spec = fft2(out, overwrite_x=True)
+    field_spec *= phase
+    field_spec = ifft2(field_spec, overwrite_x=True)
+
+    if field_spec is not out:
+        out[...] = field_spec
 
     return out
 
+# Propagates a field to a number of distances with a single forward FFT
+def propagate_many(field, zs, wavelength, dx, dy, scale_factor=1, batch_size=None, spectrum=None):
+    '''Lazily propagates a field to every distance in zs.
+
+    The forward spectrum is computed once (or taken from spectrum, see field_spectrum),
+    so each plane costs a single inverse FFT. The per-plane kernels are not stored in
+    the transfer function cache to avoid evicting the live reconstruction ones.
+
+    Inputs:
+        field: complex field, ignored if spectrum is given
+        zs: propagation distances
+        batch_size: if given, planes are computed batch_size at a time
+
+    Yields:
+        (z, field) for every distance, or (zs, fields) with fields of shape
+        (len(zs), M, N) for every batch if batch_size is given.
+    '''
+    if spectrum is None:
+        spectrum = field_spectrum(field)
+
+    zs = np.asarray(zs)
+    dtype = complex_dtype(spectrum.dtype)
+    root = _kernel_root(spectrum.shape, wavelength, dx, dy)
+
+    if batch_size is None:
+        for z in zs:
+            yield z, ifft2(spectrum * _kernel_phase(root, z, scale_factor, dtype), overwrite_x=True)
+        return
+
+    for i in range(0, len(zs), batch_size):
+        batch = zs[i:i + batch_size]
+        stack = np.stack([spectrum * _kernel_phase(root, z, scale_factor, dtype) for z in batch])
+
+        yield batch, ifft2(stack, axes=(-2, -1), overwrite_x=True)
+
+# Number of tile sized complex arrays alive at once in propagate_tiled (tile, kernel, FFT work)
+_TILE_WORK_COPIES = 3
+
+def guard_band(z, wavelength, dxy, scale_factor=1, margin=2):
+    '''Number of pixels the angular spectrum spreads a point at distance z.
+
+    The steepest propagating plane wave sampled with pitch dxy travels at
+    sin(theta) = wavelength*min(1/(2*dxy), 1/wavelength), light from outside
+    that band can not reach a pixel after propagating z. The ringing of the band
+    limited kernel reaches further, so the spread is multiplied by margin.
+    '''
+    sin_theta = min(wavelength / (2 * dxy), 1)
+    if sin_theta >= 1:
+        raise ValueError('The pitch resolves evanescent waves, the guard band must be given explicitly')
+
+    spread = abs(z * scale_factor) * sin_theta / np.sqrt(1 - sin_theta**2)
+
+    return int(np.ceil(margin * spread / dxy))
+
+# Propagates a field larger than memory tile by tile (overlap-save)
+def propagate_tiled(source, destination, z, wavelength, dx, dy, scale_factor=1,
+                    memory_budget=TILED_MEMORY_BUDGET, guard=None, margin=2):
+    '''Propagates source into destination reading and writing one tile at a time.
+
+    source is any 2D array, usually a numpy.memmap; destination is an array of the
+    same shape (e.g. a memmap opened in w+ mode) or a path where a complex .npy memmap
+    is created. Each tile is read with a guard band around it (see guard_band with
+    margin, or (guard_y, guard_x) given explicitly), propagated, and only its interior
+    is written. The result approximates the propagation of the field padded with zeros
+    instead of the periodic one of propagate: light from beyond the guard band is lost,
+    which with the default margin=2 is an error of about 1% RMS (a few % at most), and
+    a larger margin trades bigger tiles for a smaller error.
+
+    The transfer function of the tiles is built once per call and not cached, so the
+    working set (tile, kernel and FFT work) stays within memory_budget bytes.
+
+    Returns the destination array.
+    '''
+    M, N = source.shape
+    dtype = complex_dtype(source.dtype)
+
+    if isinstance(destination, str):
+        destination = np.lib.format.open_memmap(destination, mode='w+', dtype=dtype, shape=(M, N))
+
+    if guard is None:
+        guard = (guard_band(z, wavelength, dy, scale_factor, margin),
+                 guard_band(z, wavelength, dx, scale_factor, margin))
+    gy, gx = guard
+
+    # Largest fast FFT length whose working set fits in the budget
+    side = int(np.sqrt(memory_budget / (_TILE_WORK_COPIES * np.dtype(dtype).itemsize)))
+    while side > 1 and sc.fft.next_fast_len(side) > side:
+        side -= 1
+
+    Ly, Lx = min(side, sc.fft.next_fast_len(M + 2*gy)), min(side, sc.fft.next_fast_len(N + 2*gx))
+    Ty, Tx = Ly - 2*gy, Lx - 2*gx
+
+    if Ty <= 0 or Tx <= 0:
+        raise ValueError(f'A memory budget of {memory_budget} bytes can not hold the guard band of {guard} pixels')
+
+    block = np.empty((Ly, Lx), dtype=dtype)
+    phase = transfer_function((Ly, Lx), z, wavelength, dx, dy, scale_factor, dtype, cache=False)
+
+    for r0 in range(0, M, Ty):
+        for c0 in range(0, N, Tx):
+            r1, c1 = min(r0 + Ty, M), min(c0 + Tx, N)
+
+            # Input window clipped to the field, the rest of the block stays zero
+            ry0, ry1 = max(r0 - gy, 0), min(r1 + gy, M)
+            cx0, cx1 = max(c0 - gx, 0), min(c1 + gx, N)
+            oy, ox = ry0 - (r0 - gy), cx0 - (c0 - gx)
+
+            block[...] = 0
+            block[oy:oy + ry1 - ry0, ox:ox + cx1 - cx0] = source[ry0:ry1, cx0:cx1]
+
+            field_spec = fft2(block, overwrite_x=True)
+            field_spec *= phase
+            field_spec = ifft2(field_spec, overwrite_x=True)
+
+            destination[r0:r1, c0:c1] = field_spec[gy:gy + r1 - r0, gx:gx + c1 - c0]
+
+    if isinstance(destination, np.memmap):
+        destination.flush()
+
+    return destination
+
 # Measure of the local variance of the input image
 def focus_variance(U: np.ndarray, S: int=3) -> np.ndarray:
     """Calculates the local variance of an array.
@@ -359,6 +931,15 @@ def focus_acutance(U:np.ndarray, sigma:int = 1) -> np.ndarray:
 
     return acutance
 
+# Mean of each downsample x downsample block of the input image
+def block_average(U:np.ndarray, downsample:int) -> np.ndarray:
+  '''Averages U over blocks of downsample x downsample pixels, dropping the incomplete edge blocks'''
+
+  N, M = np.shape(U)[:2]
+  n, m = N//downsample, M//downsample
+
+  return U[:n*downsample, :m*downsample].reshape(n, downsample, m, downsample).mean(axis=(1, 3))
+
 # Metric of the mean variance of the input image
 def metric_variance(U:np.ndarray) -> float:
   '''returns the variance of a complex array'''
@@ -402,9 +983,8 @@ def focus3D(U:np.ndarray,
 
   focuss = []
 
-  for z in range_:
-    U_prop = propagate(U, z, lmbda, dx, dy,
-                       scale_factor=scale_factor)
+  for z, U_prop in propagate_many(U, range_, lmbda, dx, dy,
+                                  scale_factor=scale_factor):
 
     focuss.append((focus_acutance(U_prop, S), focus_variance(U_prop, S),
                           z,
@@ -413,33 +993,125 @@ def focus3D(U:np.ndarray,
   return focuss
 
 
+# Spectrum shared with the focus3D_parallel workers, set by _attach_spectrum
+_shared_spectrum = {}
+
+def _attach_spectrum(name, shape, dtype, backend, fft_workers):
+    '''Worker initializer, maps the shared spectrum without copying it.'''
+    shm = shared_memory.SharedMemory(name=name)
+    _shared_spectrum['shm'] = shm
+    _shared_spectrum['spectrum'] = np.ndarray(shape, dtype=dtype, buffer=shm.buf)
+
+    init_worker(backend, fft_workers)
+
+def _focus3D_chunk(zs, lmbda, dx, dy, S, scale_factor):
+    '''Computes the focus3D tuples of a chunk of distances from the shared spectrum.'''
+    return [(focus_acutance(U_prop, S), focus_variance(U_prop, S), z, U_prop)
+            for z, U_prop in propagate_many(None, zs, lmbda, dx, dy, scale_factor,
+                                            spectrum=_shared_spectrum['spectrum'])]
+
+# Same as focus3D, with the distances spread over a pool of processes
+def focus3D_parallel(U:np.ndarray,
+                     range_:np.ndarray,
+                     lmbda:float,
+                     dx:float,
+                     dy:float,
+                     S:int,
+                     scale_factor:float=1,
+                     workers:int=None,
+                     chunk_size:int=1,
+                     fft_workers:int=1):
+    """Parallel version of focus3D.
+
+    The spectrum of U is computed once and placed in shared memory, workers map it
+    instead of receiving a pickled copy per task. Chunks of chunk_size distances are
+    processed by each task.
+
+    Inputs:
+        U, range_, lmbda, dx, dy, S, scale_factor: as in focus3D.
+        workers: number of processes, all cores by default.
+        chunk_size: number of distances per task.
+        fft_workers: FFT threads inside each worker.
+
+    Yields:
+        (acutance, variance, z, field) for every distance, in the order of range_.
+    """
+    spectrum = field_spectrum(U)
+
+    shm = shared_memory.SharedMemory(create=True, size=spectrum.nbytes)
+    shared = np.ndarray(spectrum.shape, dtype=spectrum.dtype, buffer=shm.buf)
+    shared[:] = spectrum
+    shape, dtype = spectrum.shape, spectrum.dtype.str
+    del spectrum
+
+    chunks = [range_[i:i+chunk_size] for i in range(0, len(range_), chunk_size)]
+
+    executor = ProcessPoolExecutor(max_workers=workers, initializer=_attach_spectrum,
+                                   initargs=(shm.name, shape, dtype, get_backend()[0], fft_workers))
+    try:
+        results = executor.map(_focus3D_chunk, chunks, repeat(lmbda), repeat(dx),
+                               repeat(dy), repeat(S), repeat(scale_factor))
+        for chunk in results:
+            yield from chunk
+    finally:
+        executor.shutdown(cancel_futures=True)
+        del shared
+        shm.close()
+        shm.unlink()
+
+
 # Propagates to a number of distances and returns the one with the most focus. 
 # A second metric to be added
 def prop_focus(U:np.ndarray, lambda_:float, dx:float,
                dy:float, min_z:float, max_z:float,
                steps:float, scale_factor:float = 1, sigma:float = 1,
-               metric:str = 'variance') -> float:
+               metric:str = 'variance', top_k:int = None) -> float:
+    '''Propagates U to steps distances between min_z and max_z and returns the most focused plane.
+
+    The sweep is streamed: only the metric of each plane and the current best field
+    (or the top_k best) are kept, so peak memory does not depend on steps. For the
+    'combined' metric, which is normalized over the whole sweep, the winning planes
+    are propagated again from the stored spectrum at the end.
+
+    Returns (field, z, metrics), or (fields, zs, metrics) ordered from most to least
+    focused if top_k is given.
+    '''
+    if metric not in ('variance', 'acutance', 'combined'):
+        raise ValueError(f'Unknown focus metric: {metric}')
 
     range_ = np.linspace(min_z, max_z, steps)
     range_ = np.round(range_, 4)
 
+    k = 1 if top_k is None else top_k
 
-    metrics = []
-    fields = []
+    spectrum = field_spectrum(U)
 
     # For combined metric
     var = []
     acu = []
 
-    for z in range_:
-        G = propagate(U, z, lambda_, dx, dy, scale_factor)
+    # (metric, index, field) of the best planes so far, lowest metric first
+    best = []
 
-        var.append(metric_variance(G))
-        acu.append(metric_acutance(G, sigma))
+    for i, (z, G) in enumerate(propagate_many(U, range_, lambda_, dx, dy, scale_factor,
+                                              spectrum=spectrum)):
 
+        if metric in ('variance', 'combined'):
+            var.append(metric_variance(G))
+        if metric in ('acutance', 'combined'):
+            acu.append(metric_acutance(G, sigma))
 
-        fields.append(G)
+        if metric=='variance':
+            value = var[-1]
+        elif metric=='acutance':
+            value = acu[-1]
+        else:
+            continue
 
+        if len(best) < k or value < best[-1][0]:
+            best.append((value, i, G))
+            best.sort(key=lambda item: (item[0], item[1]))
+            del best[k:]
 
     var = np.array(var)
     acu = np.array(acu)
@@ -449,13 +1121,102 @@ def prop_focus(U:np.ndarray, lambda_:float, dx:float,
         metrics = var
     elif metric=='acutance':
         metrics = acu
-    elif metric=='combined':
+    else:
         metrics = normalize(var, 1)+normalize(acu, 1)
 
-    #Variance is low for focused translucent samples and high for focused opaque samples
-    min_focus = np.min(metrics)
-    min_ind = np.argmin(metrics)
-    return fields[min_ind], range_[min_ind], metrics
+        #Variance is low for focused translucent samples and high for focused opaque samples
+        best = [(metrics[i], i, propagate_spectrum(spectrum, range_[i], lambda_, dx, dy, scale_factor,
+                                                   cache=False))
+                for i in np.argsort(metrics, kind='stable')[:k]]
+
+    if top_k is None:
+        _, min_ind, field = best[0]
+        return field, range_[min_ind], metrics
+
+    return [field for _, _, field in best], range_[[i for _, i, _ in best]], metrics
+
+
+# Finds the focus with a coarse scan followed by a bounded Brent refinement
+def search_focus(U:np.ndarray, lambda_:float, dx:float,
+                 dy:float, min_z:float, max_z:float,
+                 coarse_steps:int = 8, scale_factor:float = 1, sigma:float = 1,
+                 metric:str = 'variance', downsample:int = 1,
+                 max_iter:int = 12, tol:float = None) -> tuple:
+    '''Searches the most focused plane between min_z and max_z with few propagations.
+
+    A coarse scan of coarse_steps planes brackets the minimum of the metric, which is
+    then refined with Brent's method (scipy's bounded minimize_scalar) down to tol
+    (1/100 of the coarse step by default) or max_iter evaluations. The 'combined'
+    metric is normalized with the extremes of the coarse scan.
+
+    With downsample > 1 every plane is still propagated at full resolution, but the
+    metric is evaluated on its amplitude block averaged by that factor, which makes the
+    metric cheaper without moving its minimum as a low-passed field would.
+
+    Returns (field, z, info) where info holds the number of propagations used and
+    the distances and metric values evaluated.
+    '''
+    spectrum = field_spectrum(U)
+
+    def measures(G):
+        if downsample > 1:
+            G = block_average(np.abs(G), downsample)
+        var = metric_variance(G) if metric in ('variance', 'combined') else 0
+        acu = metric_acutance(G, sigma) if metric in ('acutance', 'combined') else 0
+        return var, acu
+
+    if metric not in ('variance', 'acutance', 'combined'):
+        raise ValueError(f'Unknown focus metric: {metric}')
+
+    zs = []
+    raw = []
+
+    range_ = np.linspace(min_z, max_z, coarse_steps)
+    for z, G in propagate_many(None, range_, lambda_, dx, dy, scale_factor,
+                               spectrum=spectrum):
+        zs.append(z)
+        raw.append(measures(G))
+
+    var, acu = np.array(raw).T
+    var_min, var_span = np.min(var), np.ptp(var) if np.ptp(var)!=0 else 1
+    acu_min, acu_span = np.min(acu), np.ptp(acu) if np.ptp(acu)!=0 else 1
+
+    def score(values):
+        var, acu = values
+        if metric=='variance':
+            return var
+        elif metric=='acutance':
+            return acu
+        return (var-var_min)/var_span + (acu-acu_min)/acu_span
+
+    scores = [score(values) for values in raw]
+
+    def objective(z):
+        G = propagate_spectrum(spectrum, z, lambda_, dx, dy, scale_factor, cache=False)
+        zs.append(z)
+        scores.append(score(measures(G)))
+        return scores[-1]
+
+    i = int(np.argmin(scores))
+    bounds = (range_[max(i-1, 0)], range_[min(i+1, coarse_steps-1)])
+
+    if tol is None:
+        tol = (max_z-min_z)/max(coarse_steps-1, 1)/100
+
+    if bounds[0] != bounds[1]:
+        sc.optimize.minimize_scalar(objective, bounds=bounds, method='bounded',
+                                    options={'xatol': tol, 'maxiter': max_iter})
+
+    best = int(np.argmin(scores))
+    z_best = zs[best]
+
+    field = propagate_spectrum(spectrum, z_best, lambda_, dx, dy, scale_factor, cache=False)
+
+    info = {'propagations': len(zs)+1,
+            'zs': np.array(zs),
+            'metrics': np.array(scores)}
+
+    return field, z_best, info
 
 
 def propgif(U, dz, lambda_, dx, dy, S, n, scale_factor = 1):
@@ -488,10 +1249,47 @@ def propgif(U, dz, lambda_, dx, dy, S, n, scale_factor = 1):
     #plt.show()
 
 
-def prepare_sample(U):
-    '''Prepares the image to be clusterized'''
-    normal = normalize(unwrap_phase(np.angle(U)), 1)
+def unwrap_decimated(U:np.ndarray, downsample:int) -> np.ndarray:
+    '''Unwrapped phase of U, unwrapping only a field downsampled by block averaging.
+
+    The coarse unwrapped phase is interpolated back to the size it covers (the rows and
+    columns left over by incomplete blocks repeat its edge) and only decides the
+    multiple of 2pi added to each wrapped full resolution pixel.
+    '''
+    N, M = np.shape(U)[:2]
+
+    # Block average of the complex field, which keeps the phase of each block
+    blocks = block_average(U, downsample)
+    n, m = blocks.shape
+
+    coarse = cv2.resize(unwrap_phase(np.angle(blocks)), (m*downsample, n*downsample),
+                        interpolation=cv2.INTER_LINEAR)
+    coarse = np.pad(coarse, ((0, N - n*downsample), (0, M - m*downsample)), mode='edge')
+
+    wrapped = np.angle(U)
+    return wrapped + 2*np.pi*np.round((coarse - wrapped)/(2*np.pi))
 
+def foreground_roi(U, downsample=4, margin=16) -> tuple:
+    '''Coarse (row_start, col_start, row_stop, col_stop) box of the foreground of U.
+
+    The box surrounds the sample_mask of the unwrapped phase of U block averaged by
+    downsample, all at the coarse resolution, grown by margin pixels on every side.
+    None if that mask is empty.
+    '''
+    blocks = block_average(U, downsample)
+    coarse = sample_mask(normalize(unwrap_phase(np.angle(blocks)), 1),
+                         min_size=max(100//downsample**2, 1))
+
+    rows, cols = np.nonzero(np.any(coarse, axis=1))[0], np.nonzero(np.any(coarse, axis=0))[0]
+    if len(rows) == 0:
+        return None
+
+    N, M = np.shape(U)[:2]
+    return (max(rows[0]*downsample - margin, 0), max(cols[0]*downsample - margin, 0),
+            min((rows[-1] + 1)*downsample + margin, N), min((cols[-1] + 1)*downsample + margin, M))
+
+def sample_mask(normal, min_size=100):
+    '''Thresholds a normalized unwrapped phase into the mask of prepare_sample.'''
     mean = np.mean(normal)
     imean = np.mean(np.ones(normal.shape) - normal)
 
@@ -520,37 +1318,188 @@ def prepare_sample(U):
     th = trunc>threshold
 
     # Cleans the image from small dots that weren't catched by the threshold
-    th_cleaned = morphology.remove_small_objects(th, min_size=100)
+    th_cleaned = morphology.remove_small_objects(th, min_size=min_size)
     th_cleaned = th_cleaned > 0 # Binarized again because it was misbehaving
 
     return th_cleaned
 
+def prepare_sample(U, downsample=1, roi=None):
+    '''Prepares the image to be clusterized
+
+    With downsample > 1 the phase is unwrapped with unwrap_decimated, which can change
+    the mask of steep phase objects (check it with sample_agreement). With roi, a
+    (row_start, col_start, row_stop, col_stop) box, only that part of U is unwrapped;
+    the rest keeps its wrapped phase, so the thresholds are still taken over the whole
+    frame. roi='auto' takes the box of foreground_roi.
+    '''
+    if isinstance(roi, str) and roi == 'auto':
+        roi = foreground_roi(U)
+
+    if roi is not None:
+        r0, c0, r1, c1 = roi
+        phase = np.angle(U)
+        wrapped = phase[r0:r1, c0:c1]
+        if downsample > 1:
+            inner = unwrap_decimated(U[r0:r1, c0:c1], downsample)
+        else:
+            inner = unwrap_phase(wrapped)
+        # Match the 2*pi offset of the unwrapped box to the wrapped phase on its edge
+        edge = np.concatenate([(wrapped - inner)[[0, -1], :].ravel(),
+                               (wrapped - inner)[:, [0, -1]].ravel()])
+        phase[r0:r1, c0:c1] = inner + 2*np.pi*np.round(np.median(edge)/(2*np.pi))
+        normal = normalize(phase, 1)
+    elif downsample > 1:
+        normal = normalize(unwrap_decimated(U, downsample), 1)
+    else:
+        normal = normalize(unwrap_phase(np.angle(U)), 1)
+
+    return sample_mask(normal)
+
+def sample_agreement(U, downsample=2, roi=None) -> dict:
+    '''Compares the prepare_sample mask of downsample and roi against the full resolution one.
+
+    Returns the fraction of pixels where both masks agree, their intersection over
+    union and the time of both paths.
+    '''
+    init_time = time.perf_counter()
+    full = prepare_sample(U)
+    time_full = time.perf_counter() - init_time
+
+    init_time = time.perf_counter()
+    fast = prepare_sample(U, downsample, roi)
+    time_fast = time.perf_counter() - init_time
+
+    union = np.count_nonzero(full | fast)
+
+    return {'agreement': np.count_nonzero(full == fast)/full.size,
+            'iou': np.count_nonzero(full & fast)/union if union else 1.0,
+            'time_full': time_full,
+            'time_fast': time_fast}
+
+
+class ObjectLabels:
+    '''Connected components of a binary mask, with the attributes of a fitted KMeans.
 
-def cluster(U, max_clusters=50, manual_clusters = None, show_elbow_graph = False):
-    '''Clusterizes the image'''
+    labels_: component (0 to n_clusters-1) of each point of vals, in the order of
+    np.where(BW)
+    cluster_centers_: (row, col) centroid of each component
+    n_clusters: number of components
+    bboxes: (row_start, col_start, row_stop, col_stop) of each component
+    areas: number of pixels of each component
+    '''
+
+    def __init__(self, labels, centers, bboxes, areas):
+        self.labels_ = labels
+        self.cluster_centers_ = centers
+        self.n_clusters = len(centers)
+        self.bboxes = bboxes
+        self.areas = areas
+
+def label_objects(BW:np.ndarray, connectivity:int = 2) -> ObjectLabels:
+    '''Labels the connected components of BW in one pass, 8-connected by default
+    (connectivity=1 for 4-connected).'''
+    structure = sc.ndimage.generate_binary_structure(2, connectivity)
+    labelled, count = sc.ndimage.label(BW, structure=structure)
+
+    # Labels of the foreground pixels in the order of np.where, starting at 0
+    rows, cols = np.nonzero(labelled)
+    labels = labelled[rows, cols] - 1
+
+    areas = np.bincount(labels, minlength=count)
+    safe_areas = np.maximum(areas, 1)
+    centers = np.column_stack((np.bincount(labels, rows, count)/safe_areas,
+                               np.bincount(labels, cols, count)/safe_areas))
+
+    bboxes = np.array([(r.start, c.start, r.stop, c.stop)
+                       for r, c in sc.ndimage.find_objects(labelled)], dtype=int).reshape(-1, 4)
+
+    return ObjectLabels(labels, centers, bboxes, areas)
+
+def _elbow_inertia(vals, k):
+    '''Inertia of the KMeans fit of k clusters, 10000 if it can not be fitted.'''
+    km = KMeans(n_clusters=k, random_state=0)
+    try:
+        km = km.fit(vals)
+        return km.inertia_
+    except:
+        return 10000
+
+def elbow_sample(vals, sample_size, seed=0):
+    '''Stratified subsample of the points, one random point in each of sample_size
+    consecutive (row-major, so spatially ordered) strata.'''
+    if len(vals) <= sample_size:
+        return vals
+
+    rng = np.random.default_rng(seed)
+    edges = np.arange(sample_size)*len(vals)/sample_size
+    idx = (edges + rng.random(sample_size)*len(vals)/sample_size).astype(int)
+    return vals[np.minimum(idx, len(vals)-1)]
+
+def cluster(U, max_clusters=50, manual_clusters = None, show_elbow_graph = False,
+            fast = False, sample_size = 5000, workers = 1, patience = None,
+            method = 'kmeans', downsample = 1, roi = None):
+    '''Clusterizes the image
+
+    With method='components' the objects are the connected components of the mask
+    (see label_objects) instead of KMeans clusters, and no elbow is computed.
+    downsample and roi are passed to prepare_sample.
+
+    With fast, the elbow curve is fitted on a stratified subsample of sample_size
+    points (see elbow_sample), workers values of k at a time in a thread pool. If
+    patience is given it stops once the knee has not changed for patience values of
+    k, which is faster but less reliable since the knee of a truncated curve tends
+    to be smaller. Only the final k is fitted on every point, exactly as in the full
+    search, so its labels are those of the full fit for that k.
+    '''
     
     #Calculate the phase of the hologram reconstruction
-    BW = prepare_sample(U)
+    BW = prepare_sample(U, downsample, roi)
 
     #Converting the image to an array of points for kmeans to cluster
     vals = np.where(BW > [0])
     vals = np.column_stack(vals)
 
+    if method == 'components':
+        return BW, vals, label_objects(BW)
+    elif method != 'kmeans':
+        raise ValueError(f'Unknown clustering method: {method}')
+
     #Determining the optimal number of clusters
     sum_squared_dist = []
 
-    for k in range(1, max_clusters):
+    if not fast:
+        for k in range(1, max_clusters):
+            sum_squared_dist.append(_elbow_inertia(vals, k))
+
+        x = range(1, max_clusters)
+        kn = KneeLocator(x, sum_squared_dist, curve='convex', direction='decreasing')
+
+    elif manual_clusters == None or show_elbow_graph:
+        sample = elbow_sample(vals, sample_size)
+        batch = max(workers, 1)
+        executor = ThreadPoolExecutor(max_workers=workers) if workers > 1 else None
+        mapper = executor.map if executor else map
+
+        knee, stable = None, 0
+        for first in range(1, max_clusters, batch):
+            ks = range(first, min(first+batch, max_clusters))
+            sum_squared_dist.extend(mapper(_elbow_inertia, repeat(sample), ks))
+
+            x = range(1, len(sum_squared_dist)+1)
+            if len(x) < 3 and ks[-1] < max_clusters-1:
+                continue
+
+            kn = KneeLocator(x, sum_squared_dist, curve='convex', direction='decreasing')
 
-        km = KMeans(n_clusters=k, random_state=0)
-        try:
-            km = km.fit(vals)
-            sum_squared_dist.append(km.inertia_)
-        except:
-            sum_squared_dist.append(10000)
-        
+            # Number of values of k evaluated since the knee last changed
+            stable = stable + len(ks) if kn.knee is not None and kn.knee == knee else 0
+            knee = kn.knee
 
-    x = range(1, max_clusters)
-    kn = KneeLocator(x, sum_squared_dist, curve='convex', direction='decreasing')
+            if patience is not None and stable >= patience:
+                break
+
+        if executor:
+            executor.shutdown()
 
     if show_elbow_graph:
 
@@ -600,43 +1549,170 @@ def window_extraction(image: np.ndarray, centers: list, window_size: tuple, rimp
 
     return sub_images
 
+def extract_windows(image:np.ndarray, centers, window_size:tuple, fill=0) -> np.ndarray:
+    '''Returns a (n_objects, h, w) stack of the windows centered on each (row, col) center.
+
+    The window of center (r, c) starts at (round(r) - h//2, round(c) - w//2). Windows
+    inside the image are gathered in one indexing of a strided view_as_windows view,
+    the ones crossing the border are padded with fill.
+    '''
+    H, W = image.shape[:2]
+    h, w = window_size
+
+    centers = np.rint(np.asarray(centers, dtype=np.float64).reshape(-1, 2)).astype(int)
+    r0, c0 = centers[:, 0] - h//2, centers[:, 1] - w//2
+
+    stack = np.full((len(centers), h, w), fill, dtype=image.dtype)
+
+    inside = (r0 >= 0) & (c0 >= 0) & (r0 + h <= H) & (c0 + w <= W)
+    if np.any(inside):
+        windows = view_as_windows(image, (h, w))
+        stack[inside] = windows[r0[inside], c0[inside]]
+
+    # Only the part of the border windows that overlaps the image is copied
+    for i in np.flatnonzero(~inside):
+        top, left = max(r0[i], 0), max(c0[i], 0)
+        bottom, right = min(r0[i] + h, H), min(c0[i] + w, W)
+        if top < bottom and left < right:
+            stack[i, top-r0[i]:bottom-r0[i], left-c0[i]:right-c0[i]] = image[top:bottom, left:right]
+
+    return stack
+
+def _stack_acutance(A:np.ndarray, sigma:float) -> np.ndarray:
+    '''metric_acutance of every image of a (n, h, w) stack of amplitudes.'''
+    gradient = np.zeros(A.shape)
+    for axis in (1, 2):
+        derivative = sc.ndimage.gaussian_filter1d(A, sigma, axis=axis, order=1)
+        derivative = sc.ndimage.gaussian_filter1d(derivative, sigma, axis=3-axis, order=0)
+        gradient += derivative**2
+
+    return np.mean(np.sqrt(gradient), axis=(1, 2))
+
+def focus_windows(stack:np.ndarray, lambda_:float, dx:float,
+                  dy:float, min_z:float, max_z:float,
+                  steps:int, scale_factor:float = 1, sigma:float = 1,
+                  metric:str = 'variance') -> tuple:
+    '''prop_focus of every window of a (n_objects, h, w) stack (see extract_windows) at once.
+
+    Every plane of the sweep is propagated for all the windows with a single batched
+    FFT, parallel across cores as set by the FFT backend, and the metrics are computed
+    per window.
+
+    Returns (fields, zs, metrics): the most focused field and distance of each window,
+    and the (n_objects, steps) metrics of the sweep.
+    '''
+    if metric not in ('variance', 'acutance', 'combined'):
+        raise ValueError(f'Unknown focus metric: {metric}')
+
+    range_ = np.linspace(min_z, max_z, steps)
+    range_ = np.round(range_, 4)
+
+    spectrum = fft2(np.asarray(stack), axes=(-2, -1))
+    dtype = complex_dtype(spectrum.dtype)
+    root = _kernel_root(spectrum.shape[-2:], lambda_, dx, dy)
+
+    n = len(spectrum)
+    var = np.zeros((n, steps))
+    acu = np.zeros((n, steps))
+
+    # Best field and metric of each window so far
+    fields = np.empty(spectrum.shape, dtype=dtype)
+    best = np.full(n, np.inf)
+    best_index = np.zeros(n, dtype=int)
+
+    for i, z in enumerate(range_):
+        planes = ifft2(spectrum * _kernel_phase(root, z, scale_factor, dtype), axes=(-2, -1), overwrite_x=True)
+        amplitude = np.abs(planes)
+
+        if metric in ('variance', 'combined'):
+            var[:, i] = np.var(amplitude, axis=(1, 2))
+        if metric in ('acutance', 'combined'):
+            acu[:, i] = _stack_acutance(amplitude, sigma)
+
+        if metric == 'combined':
+            continue
+
+        value = var[:, i] if metric == 'variance' else acu[:, i]
+        better = value < best
+        fields[better] = planes[better]
+        best[better] = value[better]
+        best_index[better] = i
+
+    if metric == 'variance':
+        metrics = var
+    elif metric == 'acutance':
+        metrics = acu
+    else:
+        # normalize of each window over its own sweep
+        def rows_normalized(x):
+            span = np.ptp(x, axis=1, keepdims=True)
+            return (x - np.min(x, axis=1, keepdims=True)) / np.where(span != 0, span, 1)
+
+        metrics = rows_normalized(var) + rows_normalized(acu)
+        best_index = np.argmin(metrics, axis=1)
+
+        # The winning planes are propagated again from the spectrum
+        phases = _kernel_phase(root, range_[best_index][:, None, None], scale_factor, dtype)
+        fields = ifft2(spectrum * phases, axes=(-2, -1), overwrite_x=True)
+
+    return fields, range_[best_index], metrics
+
+def spheres_phase(shape:tuple, radii, positions, ns, lambda_, dxy, scale_factor, n0=1) -> np.ndarray:
+    '''Phase shift of a number of pure-phase spheres in one plane of the given shape.
+
+    Each sphere is only evaluated inside its bounding box, the phases of overlapping
+    spheres add up. See sphere_phase_shift for the parameters of each sphere.
+    '''
+    N, M = shape
+
+    angle = np.zeros((N, M))
+
+    for radius, pos, n in zip(np.atleast_1d(radii), np.reshape(positions, (-1, 2)), np.atleast_1d(ns)):
+        radius = radius*scale_factor/dxy
+
+        # Center of the sphere, x along the columns and y along the rows
+        cx, cy = pos[0]*dxy+M//2, pos[1]*dxy+N//2
+
+        # Pixels that can be inside the sphere
+        x0, x1 = max(int(np.ceil(cx-radius)), 0), min(int(np.floor(cx+radius))+1, M)
+        y0, y1 = max(int(np.ceil(cy-radius)), 0), min(int(np.floor(cy+radius))+1, N)
+        if x0 >= x1 or y0 >= y1:
+            continue
+
+        y, x = np.ogrid[y0:y1, x0:x1]
+        r2 = (x-cx)**2 + (y-cy)**2
+        inside = r2 < radius**2
+
+        # The phase shift corresponding to a change in index of refraction is equal to 2pi(OPL)/lambda where
+        # OPL=optical path length, and is equal to (n2-n1)*d where d is the distance, in this case
+        # d corresponds to the width of a sphere in the direction of z. Naturally, the scale factor introduces
+        # a difference between the real size of the object and its apparent size in the camera, changing the
+        # aparent optical path difference, which is corrected by dividing by the scale factor
+        angle[y0:y1, x0:x1] += np.where(inside,
+                                        2*np.pi*(n-n0)/lambda_ * (radius - np.sqrt(r2))*dxy/scale_factor,
+                                        0)
+
+    return angle
+
 def sphere_phase_shift(input_field, radius, pos, n, lambda_, dxy, scale_factor, n0=1):
     '''Produces a spherical phase shift in the input field
    
     The input field is affected by a pure-phase object in the shape of a sphere,
     locally inducing a phase shift without affecting its amplitude
 
-    radius: real radius of the sphere in length units
+    radius: real radius of the sphere in length units (or an array of radii)
     pos: real position of the sphere in the image in length units relative to the
-    center of the image
-    n: Refractive index of the sphere
+    center of the image (or an array of positions)
+    n: Refractive index of the sphere (or an array of indices)
     z: real distance from the sphere to the image in length units
     lambda_: wavelength of light in length units
     dx, dy: pixel pitches in length units
     scale_factor: scale factor induced by microscope magnification, affects z
     n0: refractive index of the liquid medium of the sample, set to air by default
-    '''
-    N, M = input_field.shape
-
-    angle = np.zeros((M, N))
-
-    radius = radius*scale_factor/dxy
 
-    for x in range(N):
-      for y in range(M):
-      
-        cx, cy = pos[0]*dxy+N//2, pos[1]*dxy+M//2
-
-        if (x-cx)**2 + (y-cy)**2 >= radius**2:
-          angle[y, x] = 0
-        else:
-          # The phase shift corresponding to a change in index of refraction is equal to 2pi(OPL)/lambda where
-          # OPL=optical path length, and is equal to (n2-n1)*d where d is the distance, in this case
-          # d corresponds to the width of a sphere in the direction of z. Naturally, the scale factor introduces
-          # a difference between the real size of the object and its apparent size in the camera, changing the 
-          # aparent optical path difference, which is corrected by dividing by the scale factor
-
-          angle[y, x] = 2*np.pi*(n-n0)/lambda_ * (radius - np.sqrt((x-cx)**2 + (y-cy)**2))*dxy/scale_factor
+    Several spheres in the same plane are rendered at once by spheres_phase.
+    '''
+    angle = spheres_phase(np.shape(input_field), radius, pos, n, lambda_, dxy, scale_factor, n0)
 
     complex = np.abs(input_field)*np.exp(1j*(np.angle(input_field)+angle))
 
@@ -652,22 +1728,30 @@ def sphere_sample(input_field, radii, xys, zs, ns, lambda_, dxy, scale_factor, n
   The final image of the sample will be propagated to a z position equal to final_prop, this position
   is equal to the position of the last sphere on the array by default
 
-  There is not a restriction of order for the z positions of the spheres or the final propagation
+  There is not a restriction of order for the z positions of the spheres or the final propagation.
+  The field goes through the planes in increasing z, with one propagation per distinct z and all
+  the spheres of a plane rendered together, so for unsorted zs the spheres are not applied in the
+  order of the array (e.g. zs=[20, 10] renders the sphere at 10 first)
   '''
 
-  N = len(radii)
+  zs = np.asarray(zs)
+  radii, ns = np.asarray(radii), np.asarray(ns)
+  xys = np.reshape(xys, (-1, 2))
 
-  for n in range(N):
-    if n==0:
-      input_field = propagate(input_field, zs[n], lambda_, dxy, dxy, scale_factor)
-      input_field = sphere_phase_shift(input_field, radii[n], xys[n], ns[n], lambda_, dxy, scale_factor, n0)
-    else:
-      input_field = propagate(input_field, zs[n]-zs[n-1], lambda_, dxy, dxy, scale_factor)
-      input_field = sphere_phase_shift(input_field, radii[n], xys[n], ns[n], lambda_, dxy, scale_factor, n0)     
+  depths = np.unique(zs)
+
+  z = 0
+  for depth in depths:
+    plane = zs == depth
+
+    input_field = propagate(input_field, depth-z, lambda_, dxy, dxy, scale_factor)
+    input_field = sphere_phase_shift(input_field, radii[plane], xys[plane], ns[plane], lambda_, dxy, scale_factor, n0)
+    z = depth
 
   if final_z==None:
-    return input_field
- 
-  input_field = propagate(input_field, final_z-zs[-1], lambda_, dxy, dxy, scale_factor)
+    final_z = zs[-1]
+
+  if final_z != z:
+    input_field = propagate(input_field, final_z-z, lambda_, dxy, dxy, scale_factor)
 
-  return input_field
\ No newline at end of file
+  return input_field
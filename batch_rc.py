@@ -0,0 +1,153 @@
+'''
+    Headless batch reconstruction of a directory of captures, no GUI is started.
+
+    python batch_rc.py saves/capture -o saves/batch --algorithm KR --L 10000 --Z 5000
+
+    Every image of the input directory (natural order, so capture2 comes before
+    capture10) is reconstructed in a pool of processes and saved as
+    <prefix><n>.<ext> in the output directory, n being its position in that order.
+    Existing files are not overwritten unless --overwrite is given.
+'''
+
+import os
+import re
+import argparse
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+
+from settings import *
+from fft_backend import get_backend, init_worker
+from reconstruction import im2arr, arr2im, reconstruct_frame
+
+IMAGE_EXTENSIONS = ('.bmp', '.png', '.jpg', '.jpeg', '.tif', '.tiff')
+
+
+def natural_key(name: str):
+    '''Sorts names with numbers by their value instead of alphabetically.'''
+    return [int(part) if part.isdigit() else part.lower() for part in re.split(r'(\d+)', name)]
+
+def list_frames(directory: str) -> list[str]:
+    '''Returns the paths of the images of a directory in natural order.'''
+    names = [name for name in os.listdir(directory) if name.lower().endswith(IMAGE_EXTENSIONS)]
+    return [os.path.join(directory, name) for name in sorted(names, key=natural_key)]
+
+def output_path(output_dir: str, prefix: str, index: int, ext: str) -> str:
+    return os.path.join(output_dir, f'{prefix}{index}.{ext}')
+
+# Reference image of the pool process, sent once by _init_worker
+_worker = {'reference': None}
+
+def _init_worker(backend: str, fft_workers: int, reference: np.ndarray):
+    _worker['reference'] = reference
+    init_worker(backend, fft_workers)
+
+def reconstruct_file(task: tuple, output_dir: str, prefix: str, ext: str, params: dict) -> str:
+    '''Reconstructs one capture and saves it, returns the output path.
+
+    The reference subtracted is the one given to the pool initializer.
+    '''
+    index, path = task
+    reference = _worker['reference']
+
+    img = im2arr(path)
+
+    # Same reference subtraction as the capture process of the GUI
+    if reference is not None:
+        if img.shape == reference.shape:
+            img = img-reference
+        else:
+            print(f'{path}: image and reference sizes do not match, reference ignored')
+
+    _, arr = reconstruct_frame(img, **params)
+
+    out_path = output_path(output_dir, prefix, index, ext)
+    arr2im(arr).save(out_path)
+
+    return out_path
+
+def batch_reconstruct(input_dir: str, output_dir: str, params: dict, reference_path: str = None,
+                      workers: int = None, chunksize: int = 4, fft_workers: int = 1,
+                      prefix: str = 'reconstruction', ext: str = 'bmp', overwrite: bool = False) -> int:
+    '''Reconstructs every frame of input_dir into output_dir, returns the number of frames.
+
+    params are the keyword arguments of reconstruction.reconstruct_frame except the image.
+    Raises FileExistsError before reconstructing anything if an output file already
+    exists, unless overwrite is True.
+    '''
+    frames = list_frames(input_dir)
+
+    if not overwrite:
+        existing = [path for path in (output_path(output_dir, prefix, index, ext) for index in range(len(frames)))
+                    if os.path.exists(path)]
+        if existing:
+            raise FileExistsError(f'{len(existing)} output files already exist, e.g. {existing[0]}')
+
+    os.makedirs(output_dir, exist_ok=True)
+
+    reference = im2arr(reference_path) if reference_path else None
+
+    work = partial(reconstruct_file, output_dir=output_dir, prefix=prefix, ext=ext, params=params)
+
+    # The reference is pickled once per process instead of once per chunk
+    with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker,
+                             initargs=(get_backend()[0], fft_workers, reference)) as executor:
+        for n, out_path in enumerate(executor.map(work, enumerate(frames), chunksize=chunksize), 1):
+            print(f'[{n}/{len(frames)}] {out_path}')
+
+    return len(frames)
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description='Reconstructs every capture of a directory.')
+    parser.add_argument('input_dir', help='Directory with the captures, e.g. saves/capture')
+    parser.add_argument('-o', '--output-dir', required=True,
+                        help='Directory for the reconstructions, created if missing')
+    parser.add_argument('-a', '--algorithm', choices=('AS', 'KR'), default='AS')
+    parser.add_argument('--L', type=float, default=INIT_L, help='Microns')
+    parser.add_argument('--Z', type=float, default=INIT_Z, help='Microns')
+    parser.add_argument('--r', type=float, default=None, help='Microns, L-Z by default')
+    parser.add_argument('--wavelength', type=float, default=DEFAULT_WAVELENGTH, help='Microns')
+    parser.add_argument('--dxy', type=float, default=DEFAULT_DXY, help='Microns')
+    parser.add_argument('--reference', default=None, help='Reference image subtracted from every capture')
+    parser.add_argument('--squared', action='store_true', help='Save the intensity')
+    parser.add_argument('--phase', action='store_true', help='Save the phase')
+    parser.add_argument('--precision', choices=('float32', 'float64'), default=RECONSTRUCTION_PRECISION)
+    parser.add_argument('--cosine-period', type=float, default=DEFAULT_COSINE_PERIOD)
+    parser.add_argument('--workers', type=int, default=None, help='Processes, all cores by default')
+    parser.add_argument('--chunksize', type=int, default=4, help='Frames sent to a process at a time')
+    parser.add_argument('--fft-workers', type=int, default=1, help='FFT threads per process')
+    parser.add_argument('--prefix', default='reconstruction')
+    parser.add_argument('--ext', default='bmp')
+    parser.add_argument('--overwrite', action='store_true', help='Replace existing output files')
+
+    return parser.parse_args(argv)
+
+def main(argv=None):
+    args = parse_args(argv)
+
+    r = args.r if args.r is not None else args.L-args.Z
+    if args.Z == 0 or (args.algorithm == 'KR' and args.L == 0):
+        raise SystemExit('L and Z must be different from 0')
+
+    params = {'algorithm': args.algorithm,
+              'L': args.L,
+              'Z': args.Z,
+              'r': r,
+              'wavelength': args.wavelength,
+              'dxy': args.dxy,
+              'scale_factor': args.L/args.Z,
+              'squared': args.squared,
+              'phase': args.phase,
+              'precision': args.precision,
+              'cosine_period': args.cosine_period}
+
+    try:
+        batch_reconstruct(args.input_dir, args.output_dir, params, args.reference,
+                          args.workers, args.chunksize, args.fft_workers, args.prefix, args.ext,
+                          args.overwrite)
+    except FileExistsError as error:
+        raise SystemExit(f'{error}, use --overwrite to replace them')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,264 @@
+'''
+    Benchmark of the reconstruction hot paths.
+
+    python benchmark.py -o results.json
+    python benchmark.py --sizes 512 1024 --cases propagate kreuzer3F --precisions float32
+    python benchmark.py -o new.json --compare baseline.json --tolerance 0.15
+
+    Every case is timed at every size (square images), precision and input
+    ('synthetic' phase objects or references/test_image.bmp resized), the results
+    (latency percentiles, throughput and peak memory) are printed and written as JSON.
+    With --compare the p50 latencies are checked against a saved run and the exit
+    code is 1 if any case got slower than the tolerance.
+'''
+
+import sys
+import json
+import time
+import argparse
+import platform
+import tracemalloc
+import numpy as np
+import cv2
+
+from settings import *
+from fft_backend import get_backend
+from _3DHR_Utilities import (normalize, precision_dtypes, propagate, compensate,
+                             prop_focus, cluster)
+from kreuzer_functions import kreuzer3F, filtcosenoF, prepairholoF, geometry_remap
+
+DEFAULT_SIZES = (256, 512, 1024, 2048, 4096)
+TEST_IMAGE = 'references/test_image.bmp'
+
+# Physical parameters of every case, the GUI defaults
+L, Z = INIT_L, INIT_Z
+WAVELENGTH, DXY = DEFAULT_WAVELENGTH, DEFAULT_DXY
+
+
+def synthetic_hologram(size: int, off_axis: bool = False) -> np.ndarray:
+    '''In-line (or off-axis) 8 bit hologram of random phase disks, always the same for a size.'''
+    rng = np.random.default_rng(size)
+    y, x = np.mgrid[:size, :size]
+
+    phase = np.zeros((size, size))
+    for _ in range(max(size//32, 4)):
+        cx, cy = rng.integers(0, size, 2)
+        radius = rng.integers(size//64 + 2, size//16 + 3)
+        phase += 1.5*np.sqrt(np.clip(1 - ((x-cx)**2 + (y-cy)**2)/radius**2, 0, None))
+
+    field = propagate(np.exp(1j*phase), 300, WAVELENGTH, DXY, DXY)
+
+    if off_axis:
+        # Tilted reference wave, carrier at a quarter of the sampling frequency
+        field = field + np.exp(1j*np.pi/2*(x + y))
+
+    return normalize(np.abs(field)**2, 255).astype(np.uint8)
+
+def load_input(name: str, size: int, off_axis: bool = False) -> np.ndarray:
+    if name == 'synthetic':
+        return synthetic_hologram(size, off_axis)
+
+    image = cv2.imread(TEST_IMAGE, cv2.IMREAD_GRAYSCALE)
+    return cv2.resize(image, (size, size), interpolation=cv2.INTER_AREA)
+
+def display_filters():
+    # Imported here because parallel_rc pulls customtkinter in
+    from parallel_rc import (gamma_filter, contrast_filter, adaptative_eq_filter,
+                             highpass_filter, lowpass_filter)
+
+    return {'gamma_filter': (gamma_filter, 0.2),
+            'contrast_filter': (contrast_filter, 1.5),
+            'adaptative_eq_filter': (adaptative_eq_filter, None),
+            'highpass_filter': (highpass_filter, DEFAULT_CUTOFF),
+            'lowpass_filter': (lowpass_filter, DEFAULT_CUTOFF)}
+
+
+# Every case takes (input name, size, precision) and returns the function to time.
+# The slowest ones are capped to a maximum size unless --no-size-caps is given.
+
+def case_propagate(name, size, precision):
+    real_type, _ = precision_dtypes(precision)
+    field = np.sqrt(normalize(load_input(name, size), 1, real_type))
+    return lambda: propagate(field, L-Z, WAVELENGTH, DXY, DXY, L/Z)
+
+def case_kreuzer3F(name, size, precision):
+    real_type, _ = precision_dtypes(precision)
+    field = np.sqrt(normalize(load_input(name, size), 1, real_type))
+    FC = filtcosenoF(DEFAULT_COSINE_PERIOD, np.array((size, size)), real_type)
+    return lambda: kreuzer3F(field, Z, L, WAVELENGTH, DXY, Z*DXY/L, FC)
+
+def case_prepairholoF(name, size, precision):
+    real_type, _ = precision_dtypes(precision)
+    field = np.sqrt(normalize(load_input(name, size), 1, real_type))
+    remap = geometry_remap(field.shape, L, DXY)
+    if real_type == np.float32:
+        remap = remap.astype(np.float32)
+    return lambda: prepairholoF(field, remap=remap)
+
+def case_compensate(**options):
+    def case(name, size, precision):
+        real_type, _ = precision_dtypes(precision)
+        hologram = load_input(name, size, off_axis=True).astype(real_type)
+        return lambda: compensate(hologram, DXY, DXY, WAVELENGTH, region=1, **options)
+    return case
+
+def case_prop_focus(name, size, precision):
+    real_type, _ = precision_dtypes(precision)
+    field = np.sqrt(normalize(load_input(name, size), 1, real_type))
+    return lambda: prop_focus(field, WAVELENGTH, DXY, DXY, -600, 0, 20)
+
+def case_cluster(**options):
+    def case(name, size, precision):
+        real_type, _ = precision_dtypes(precision)
+        field = np.sqrt(normalize(load_input(name, size), 1, real_type))
+        field = propagate(field, -300, WAVELENGTH, DXY, DXY)
+        return lambda: cluster(field, max_clusters=10, **options)
+    return case
+
+def case_filter(filter_name):
+    def case(name, size, precision):
+        real_type, _ = precision_dtypes(precision)
+        arr = normalize(load_input(name, size), 255, real_type)
+        function, param = display_filters()[filter_name]
+        return lambda: function(arr, param)
+    return case
+
+CASES = {'propagate': (case_propagate, None),
+         'kreuzer3F': (case_kreuzer3F, None),
+         'prepairholoF': (case_prepairholoF, None),
+         'compensate': (case_compensate(), 2048),
+         'compensate_dft': (case_compensate(carrier='dft'), None),
+         'compensate_window': (case_compensate(window=256), None),
+         'prop_focus': (case_prop_focus, 2048),
+         'cluster': (case_cluster(), 1024),
+         'cluster_fast': (case_cluster(fast=True), 2048),
+         'cluster_components': (case_cluster(method='components'), None),
+         'gamma_filter': (case_filter('gamma_filter'), None),
+         'contrast_filter': (case_filter('contrast_filter'), None),
+         'adaptative_eq_filter': (case_filter('adaptative_eq_filter'), None),
+         'highpass_filter': (case_filter('highpass_filter'), None),
+         'lowpass_filter': (case_filter('lowpass_filter'), None)}
+
+
+def time_case(function, repeats: int, warmup: int) -> dict:
+    '''Latency statistics, throughput and peak traced memory of a function.'''
+    for _ in range(warmup):
+        function()
+
+    times = []
+    for _ in range(repeats):
+        init_time = time.perf_counter()
+        function()
+        times.append(time.perf_counter()-init_time)
+
+    # Separate run, tracing slows the allocations down
+    tracemalloc.start()
+    function()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    times = np.array(times)
+    return {'repeats': repeats,
+            'mean_s': float(np.mean(times)),
+            'min_s': float(np.min(times)),
+            'p50_s': float(np.percentile(times, 50)),
+            'p95_s': float(np.percentile(times, 95)),
+            'p99_s': float(np.percentile(times, 99)),
+            'throughput_fps': float(1/np.mean(times)),
+            'peak_memory_bytes': int(peak)}
+
+def run(cases, sizes, precisions, inputs, repeats, warmup, size_caps=True) -> dict:
+    backend, workers = get_backend()
+    results = []
+
+    for case in cases:
+        setup, max_size = CASES[case]
+        for size in sizes:
+            if size_caps and max_size is not None and size > max_size:
+                continue
+            for precision in precisions:
+                for name in inputs:
+                    stats = time_case(setup(name, size, precision), repeats, warmup)
+                    stats.update({'case': case, 'size': size, 'precision': precision, 'input': name,
+                                  'mpixels_per_s': size*size/1e6*stats['throughput_fps']})
+                    results.append(stats)
+
+                    print(f"{case:22} {size:5} {precision:8} {name:10} "
+                          f"p50 {stats['p50_s']*1e3:10.2f} ms  p95 {stats['p95_s']*1e3:10.2f} ms  "
+                          f"{stats['throughput_fps']:8.2f} fps  {stats['peak_memory_bytes']/2**20:9.1f} MiB")
+
+    return {'meta': {'python': platform.python_version(),
+                     'numpy': np.__version__,
+                     'platform': platform.platform(),
+                     'processor': platform.processor(),
+                     'fft_backend': backend,
+                     'fft_workers': workers,
+                     'time': time.strftime('%Y-%m-%d %H:%M:%S')},
+            'results': results}
+
+def compare(current: dict, baseline: dict, tolerance: float) -> list[dict]:
+    '''Compares the p50 latency of every case present in both runs.
+
+    Returns the comparisons, regressions being those slower than 1+tolerance times
+    the baseline.
+    '''
+    key = lambda r: (r['case'], r['size'], r['precision'], r['input'])
+    previous = {key(r): r for r in baseline['results']}
+
+    comparisons = []
+    for result in current['results']:
+        old = previous.get(key(result))
+        if old is None:
+            continue
+
+        ratio = result['p50_s']/old['p50_s'] if old['p50_s'] != 0 else float('inf')
+        comparisons.append({'case': result['case'], 'size': result['size'],
+                            'precision': result['precision'], 'input': result['input'],
+                            'baseline_p50_s': old['p50_s'], 'p50_s': result['p50_s'],
+                            'ratio': ratio, 'regression': ratio > 1+tolerance})
+
+    return comparisons
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmarks the reconstruction hot paths.')
+    parser.add_argument('--cases', nargs='+', choices=list(CASES), default=list(CASES))
+    parser.add_argument('--sizes', nargs='+', type=int, default=list(DEFAULT_SIZES))
+    parser.add_argument('--precisions', nargs='+', choices=('float64', 'float32'), default=['float64', 'float32'])
+    parser.add_argument('--inputs', nargs='+', choices=('synthetic', 'test_image'), default=['synthetic', 'test_image'])
+    parser.add_argument('--repeats', type=int, default=5)
+    parser.add_argument('--warmup', type=int, default=1)
+    parser.add_argument('--no-size-caps', action='store_true', help='Run the slowest cases at every size')
+    parser.add_argument('-o', '--output', default=None, help='JSON file for the results')
+    parser.add_argument('--compare', default=None, help='JSON file of a previous run')
+    parser.add_argument('--tolerance', type=float, default=0.1, help='Allowed p50 slowdown against --compare')
+
+    return parser.parse_args(argv)
+
+def main(argv=None) -> int:
+    args = parse_args(argv)
+
+    report = run(args.cases, args.sizes, args.precisions, args.inputs,
+                 args.repeats, args.warmup, not args.no_size_caps)
+
+    regressions = []
+    if args.compare:
+        with open(args.compare) as file:
+            comparisons = compare(report, json.load(file), args.tolerance)
+        report['comparison'] = {'baseline': args.compare, 'tolerance': args.tolerance,
+                                'results': comparisons}
+
+        print()
+        for c in comparisons:
+            flag = 'REGRESSION' if c['regression'] else ''
+            print(f"{c['case']:22} {c['size']:5} {c['precision']:8} {c['input']:10} x{c['ratio']:6.2f} {flag}")
+        regressions = [c for c in comparisons if c['regression']]
+
+    if args.output:
+        with open(args.output, 'w') as file:
+            json.dump(report, file, indent=2)
+
+    return 1 if regressions else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
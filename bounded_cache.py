@@ -0,0 +1,67 @@
+'''Bounded least recently used cache of the kernels, filters and remaps that the
+reconstruction rebuilds for every frame unless the geometry changes.
+
+    _filter_cache = BoundedCache(FILTER_CACHE_SIZE)
+
+    FC = _filter_cache.get(key)
+    if FC is None:
+        FC = _filter_cache.put(key, build_filter())
+
+Arrays stored with put are made read-only, since the same object is handed to every
+caller. A max_size of 0 disables the cache, put then only returns the value.
+'''
+
+from collections import OrderedDict
+
+
+class BoundedCache:
+    '''Keeps the max_size most recently used values, with hit and miss counters.'''
+
+    def __init__(self, max_size: int):
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self._items = OrderedDict()
+
+    def __len__(self) -> int:
+        return len(self._items)
+
+    def get(self, key):
+        '''Returns the value stored for key, or None (counted as a miss).'''
+        value = self._items.get(key)
+        if value is None:
+            self.misses += 1
+            return None
+
+        self._items.move_to_end(key)
+        self.hits += 1
+        return value
+
+    def put(self, key, value):
+        '''Stores value for key, evicting the least recently used values, and returns it.'''
+        if hasattr(value, 'setflags'):
+            value.setflags(write=False)
+
+        if self.max_size > 0:
+            self._items[key] = value
+            self._items.move_to_end(key)
+            while len(self._items) > self.max_size:
+                self._items.popitem(last=False)
+
+        return value
+
+    def clear(self, max_size: int = None) -> None:
+        '''Empties the cache and resets its counters, changing its bound if max_size is given.'''
+        self._items.clear()
+        self.hits = 0
+        self.misses = 0
+
+        if max_size is not None:
+            self.max_size = max_size
+
+    def info(self) -> dict:
+        '''Returns the hit/miss counters, current size and bound of the cache.'''
+        return {'hits': self.hits,
+                'misses': self.misses,
+                'size': len(self._items),
+                'max_size': self.max_size}
@@ -0,0 +1,127 @@
+'''FFT backend shared by every transform of the project.
+
+The backend is chosen at runtime with set_backend, the defaults come from settings.py:
+
+    'scipy':  scipy.fft with a pool of workers (default)
+    'pyfftw': pyFFTW through its scipy interface, plans are cached in memory and their
+              wisdom is persisted to FFTW_WISDOM_PATH between runs (optional dependency)
+    'numpy':  numpy.fft, single threaded
+
+All functions keep the numpy.fft signatures used in the project.
+'''
+
+import os
+import atexit
+import pickle
+import numpy as np
+import scipy.fft
+
+from settings import FFT_BACKEND, FFT_WORKERS, FFTW_WISDOM_PATH
+
+_backend = {'name': None, 'module': None, 'workers': None}
+
+
+def _resolve_workers(workers):
+    '''Converts the scipy convention (-1 = all cores) to an explicit count.'''
+    if workers is None or workers < 1:
+        return os.cpu_count() or 1
+    return workers
+
+
+def save_wisdom(path: str = FFTW_WISDOM_PATH) -> None:
+    '''Saves the pyFFTW plans accumulated so far, does nothing for other backends.'''
+    if _backend['name'] != 'pyfftw':
+        return
+
+    import pyfftw
+
+    try:
+        with open(path, 'wb') as file:
+            pickle.dump(pyfftw.export_wisdom(), file)
+    except OSError as e:
+        print(f'Could not save FFTW wisdom: {e}')
+
+
+def _load_pyfftw():
+    import pyfftw
+    import pyfftw.interfaces.scipy_fft as pyfftw_fft
+
+    # Keeps the FFTW objects alive between calls so plans are not rebuilt
+    pyfftw.interfaces.cache.enable()
+    pyfftw.interfaces.cache.set_keepalive_time(60)
+
+    if os.path.exists(FFTW_WISDOM_PATH):
+        try:
+            with open(FFTW_WISDOM_PATH, 'rb') as file:
+                pyfftw.import_wisdom(pickle.load(file))
+        except (OSError, pickle.UnpicklingError, EOFError) as e:
+            print(f'Could not load FFTW wisdom: {e}')
+
+    atexit.register(save_wisdom)
+
+    return pyfftw_fft
+
+
+def set_backend(name: str = FFT_BACKEND, workers: int = FFT_WORKERS) -> None:
+    '''Selects the FFT implementation and the number of threads it may use.
+
+    Falls back to scipy if pyFFTW is requested but not installed.
+    '''
+    if name == 'pyfftw':
+        try:
+            module = _load_pyfftw()
+        except ImportError:
+            print('pyFFTW is not installed, using scipy.fft instead')
+            name, module = 'scipy', scipy.fft
+    elif name == 'scipy':
+        module = scipy.fft
+    elif name == 'numpy':
+        module = np.fft
+    else:
+        raise ValueError(f'Unknown FFT backend: {name}')
+
+    _backend['name'] = name
+    _backend['module'] = module
+    _backend['workers'] = _resolve_workers(workers)
+
+
+def get_backend() -> tuple[str, int]:
+    '''Returns the name of the current backend and its number of workers.'''
+    return _backend['name'], _backend['workers']
+
+
+def init_worker(name: str, workers: int = 1) -> None:
+    '''Selects the backend of a pool process, pass get_backend()[0] of the parent as name.
+
+    Each process already takes a core, so threaded FFTs (workers > 1) would
+    oversubscribe the machine.
+    '''
+    set_backend(name, workers)
+
+
+def fft2(x, s=None, axes=(-2, -1), overwrite_x=False):
+    '''2D forward FFT with the current backend.
+
+    With overwrite_x the input may be used as the output buffer (ignored by numpy),
+    callers must use the returned array.
+    '''
+    if _backend['name'] == 'numpy':
+        return np.fft.fft2(x, s=s, axes=axes)
+    return _backend['module'].fft2(x, s=s, axes=axes, overwrite_x=overwrite_x,
+                                   workers=_backend['workers'])
+
+
+def ifft2(x, s=None, axes=(-2, -1), overwrite_x=False):
+    '''2D inverse FFT with the current backend, see fft2 for overwrite_x.'''
+    if _backend['name'] == 'numpy':
+        return np.fft.ifft2(x, s=s, axes=axes)
+    return _backend['module'].ifft2(x, s=s, axes=axes, overwrite_x=overwrite_x,
+                                    workers=_backend['workers'])
+
+
+# Shifts are plain array rolls, the same for every backend
+fftshift = np.fft.fftshift
+ifftshift = np.fft.ifftshift
+
+
+set_backend()
@@ -1,12 +1,49 @@
 import numpy as np
-from numpy.fft import fftshift, fft2, ifftshift, ifft2
 from scipy.ndimage import map_coordinates
+from scipy import sparse
 import matplotlib.pyplot as plt
 
-from _3DHR_Utilities import propagate
+from settings import REMAP_CACHE_SIZE, FILTER_CACHE_SIZE
+from fft_backend import fftshift, fft2, ifftshift, ifft2
+from bounded_cache import BoundedCache
+from _3DHR_Utilities import propagate, complex_dtype, transfer_cache
 
 
 
+# Kernels of ang_spectrum in FFT order, kept in the transfer function cache of propagate
+# (so transfer_cache_info and clear_transfer_cache cover them) by (shape, z, wavelength, dx, dy)
+def ang_spectrum_kernel(shape, z, wavelength, dx, dy):
+    """
+    Returns the (cached) transfer function of ang_spectrum, already in FFT order.
+
+    Parameters:
+    shape (tuple): Field shape (rows, cols)
+    z (float): Propagation distance
+    wavelength (float): Wavelength
+    dx, dy (float): Sampling step sizes along x and y axes
+
+    Returns:
+    phase (2D array): Transfer function (read-only)
+    """
+    key = ('ang_spectrum', tuple(shape), float(z), float(wavelength), float(dx), float(dy))
+
+    phase = transfer_cache.get(key)
+    if phase is not None:
+        return phase
+
+    N, M = shape
+    dfx = 1 / (dx * M)
+    dfy = 1 / (dy * N)
+
+    # Frequency indices already in FFT order, only the 1D axes are shifted, so no
+    # meshgrid or 2D ifftshift is needed (the shifts of the field cancel out, see propagate)
+    m = ifftshift(np.arange(1 - M / 2, M / 2 + 1))
+    n = ifftshift(np.arange(1 - N / 2, N / 2 + 1))
+
+    phase = np.exp(1j * z * 2 * np.pi * np.sqrt((1 / wavelength) ** 2 - (m[None, :] * dfx) ** 2 - (n[:, None] * dfy) ** 2))
+
+    return transfer_cache.put(key, phase)
+
 def ang_spectrum(field, z, wavelength, dx, dy):
     """
     Propagates a complex field using the angular spectrum method.
@@ -20,30 +57,28 @@ def ang_spectrum(field, z, wavelength, dx, dy):
     Returns:
     out (2D array): Field after propagation
     """
-    N, M = field.shape
-    m, n = np.meshgrid(np.arange(1 - M / 2, M / 2 + 1), np.arange(1 - N / 2, N / 2 + 1))
-    dfx = 1 / (dx * M)
-    dfy = 1 / (dy * N)
+    phase = ang_spectrum_kernel(field.shape, z, wavelength, dx, dy)
 
-    field_spec = fftshift(fft2(fftshift(field)))
-    phase = np.exp(1j * z * 2 * np.pi * np.sqrt((1 / wavelength) ** 2 - (m * dfx) ** 2 - (n * dfy) ** 2))
-    out = ifftshift(ifft2(ifftshift(field_spec * phase)))
+    out = fft2(field)
+    out *= phase
+    out = ifft2(out, overwrite_x=True)
 
     return out
 
 
-def filtcosenoF(par, fi:np.ndarray):
+def filtcosenoF(par, fi:np.ndarray, dtype=np.float64):
     """
     Creates a cosine filter.
 
     Parameters:
     par (int): Cosine period
     fi (int): Size of the filter
+    dtype (dtype, optional): Precision of the filter
 
     Returns:
     FC (2D array): Cosine filter
     """
-    Xfc, Yfc = np.meshgrid(np.linspace(-fi[0] // 2, fi[0] // 2, int(fi[0])), np.linspace(fi[1] // 2, -fi[1] // 2, int(fi[1])))
+    Xfc, Yfc = np.meshgrid(np.linspace(-fi[0] // 2, fi[0] // 2, int(fi[0]), dtype=dtype), np.linspace(fi[1] // 2, -fi[1] // 2, int(fi[1]), dtype=dtype))
     FC1 = np.cos(Xfc * (np.pi / par) * (1 / np.max(np.abs(Xfc)))) ** 2
     FC2 = np.cos(Yfc * (np.pi / par) * (1 / np.max(np.abs(Yfc)))) ** 2
     FC = (FC1 > 0) * FC1 * (FC2 > 0) * FC2
@@ -52,6 +87,35 @@ def filtcosenoF(par, fi:np.ndarray):
     return FC
 
 
+# Cosine filters of the last (period, shape, dtype, padding) used
+_filter_cache = BoundedCache(FILTER_CACHE_SIZE)
+
+def cosine_filter(par, fi, dtype=np.float64, pad=0):
+    """
+    Returns the (cached) cosine filter of filtcosenoF, optionally zero padded.
+
+    Parameters:
+    par (int): Cosine period
+    fi (int): Size of the filter
+    dtype (dtype, optional): Precision of the filter
+    pad (int, optional): Zeros added on every side
+
+    Returns:
+    FC (2D array): Cosine filter (read-only)
+    """
+    key = (float(par), int(fi[0]), int(fi[1]), np.dtype(dtype).str, int(pad))
+
+    FC = _filter_cache.get(key)
+    if FC is not None:
+        return FC
+
+    FC = filtcosenoF(par, fi, dtype)
+    if pad:
+        FC = np.pad(FC, ((pad, pad), (pad, pad)), mode='constant')
+
+    return _filter_cache.put(key, FC)
+
+
 def normalize(image):
     """
     Normalizes an image to the [0, 1] range.
@@ -91,118 +155,270 @@ def point_src(M, z, x0, y0, wavelength, dx):
 
 
 
-def prepairholoF(CH_m, xop, yop, Xp, Yp):
+def projected_coordinates(shape, L, dx):
     """
-    Prepare the hologram using bilinear interpolation, preserving the complex data.
+    Computes the projected coordinates of the hologram pixels used by Kreuzer's method.
 
     Parameters:
-    CH_m (2D array, complex): Original hologram matrix.
+    shape (tuple): Hologram shape (rows, cols)
+    L (float): Length parameter
+    dx (float): Pixel size of the hologram
+
+    Returns:
+    xop, yop (float): Center coordinates of the projected hologram
+    Xp, Yp (2D arrays): Projected coordinates
+    """
+    n_rows, n_cols = shape
+    W = dx * n_cols
+    H = dx * n_rows
+
+    X, Y = np.meshgrid(np.arange(1, n_cols + 1), np.arange(1, n_rows + 1))
+
+    xo = -W / 2
+    yo = -H / 2
+    xop = xo * L / np.sqrt(L ** 2 + xo ** 2)
+    yop = yo * L / np.sqrt(L ** 2 + yo ** 2)
+
+    Xp = (dx * (X - n_cols / 2) * L) / np.sqrt(L ** 2 + (dx ** 2) * (X - n_cols / 2) ** 2 + (dx ** 2) * (Y - n_rows / 2) ** 2)
+    Yp = (dx * (Y - n_rows / 2) * L) / np.sqrt(L ** 2 + (dx ** 2) * (Y - n_rows / 2) ** 2 + (dx ** 2) * (Y - n_rows / 2) ** 2)
+
+    return xop, yop, Xp, Yp
+
+
+def remap_matrix(shape, xop, yop, Xp, Yp):
+    """
+    Builds the sparse bilinear scatter used by prepairholoF.
+
+    The matrix only depends on the geometry, so it can be reused for every
+    hologram with the same shape, L and dx.
+
+    Parameters:
+    shape (tuple): Hologram shape (rows, cols)
     xop, yop (float): Center coordinates of the hologram.
     Xp, Yp (2D arrays): New coordinates for interpolation.
 
     Returns:
-    CHp_m (2D array, complex): Prepared hologram.
+    remap (sparse matrix): Maps the flattened hologram to the flattened prepared hologram.
     """
-    n_rows, n_cols = CH_m.shape
+    n_rows, n_cols = shape
     Xcoord = (Xp - xop) / (-2 * xop / n_cols)
     Ycoord = (Yp - yop) / (-2 * yop / n_rows)
-    
+
     # Ensure coordinates are within bounds
     Xcoord = np.clip(Xcoord, 0, n_cols - 2)
     Ycoord = np.clip(Ycoord, 0, n_rows - 2)
-    
+
     # Calculate integer part (floored)
     iXcoord = np.floor(Xcoord).astype(int)
     iYcoord = np.floor(Ycoord).astype(int)
-    
+
     # Calculate fractional part for interpolation
     x1frac = (iXcoord + 1.0) - Xcoord
     x2frac = 1.0 - x1frac
     y1frac = (iYcoord + 1.0) - Ycoord
     y2frac = 1.0 - y1frac
-    
-    # Bilinear interpolation coefficients
-    x1y1 = x1frac * y1frac
-    x1y2 = x1frac * y2frac
-    x2y1 = x2frac * y1frac
-    x2y2 = x2frac * y2frac
-    
-    # Initialize complex result matrix
-    CHp_m = np.zeros((n_rows, n_cols), dtype=complex)
-    
-    # Apply bilinear interpolation
-    for it in range(n_rows - 1):
-        for jt in range(n_cols - 1):
-            CHp_m[iYcoord[it, jt], iXcoord[it, jt]] += (x1y1[it, jt]) * CH_m[it, jt]
-            CHp_m[iYcoord[it, jt], iXcoord[it, jt] + 1] += (x2y1[it, jt]) * CH_m[it, jt]
-            CHp_m[iYcoord[it, jt] + 1, iXcoord[it, jt]] += (x1y2[it, jt]) * CH_m[it, jt]
-            CHp_m[iYcoord[it, jt] + 1, iXcoord[it, jt] + 1] += (x2y2[it, jt]) * CH_m[it, jt]
-
-    return CHp_m
 
+    # The last row and column of the hologram are not scattered
+    inner = (slice(0, n_rows - 1), slice(0, n_cols - 1))
+    src = np.arange(n_rows * n_cols).reshape(n_rows, n_cols)[inner].ravel()
+    dst = (iYcoord[inner] * n_cols + iXcoord[inner]).ravel()
 
-def kreuzer3F(hologram, z, L, wavelength, dx, deltaX, FC):
+    # Bilinear interpolation coefficients for each of the four neighbours
+    rows = np.concatenate((dst, dst + 1, dst + n_cols, dst + n_cols + 1))
+    cols = np.tile(src, 4)
+    data = np.concatenate(((x1frac * y1frac)[inner].ravel(),
+                           (x2frac * y1frac)[inner].ravel(),
+                           (x1frac * y2frac)[inner].ravel(),
+                           (x2frac * y2frac)[inner].ravel()))
+
+    size = n_rows * n_cols
+    return sparse.csr_matrix((data, (rows, cols)), shape=(size, size))
+
+
+# Remap matrices of the last geometries used, keyed by (shape, L, dx)
+_remap_cache = BoundedCache(REMAP_CACHE_SIZE)
+
+def geometry_remap(shape, L, dx):
     """
-    Reconstructs an in-line hologram using Kreuzer's method.
+    Returns the (cached) remap matrix of prepairholoF for the given geometry.
 
     Parameters:
-    hologram (2D array): Hologram matrix
+    shape (tuple): Hologram shape (rows, cols)
+    L (float): Length parameter
+    dx (float): Pixel size of the hologram
+
+    Returns:
+    remap (sparse matrix): See remap_matrix
+    """
+    key = (tuple(shape), float(L), float(dx))
+
+    remap = _remap_cache.get(key)
+    if remap is not None:
+        return remap
+
+    xop, yop, Xp, Yp = projected_coordinates(shape, L, dx)
+    remap = remap_matrix(shape, xop, yop, Xp, Yp)
+
+    return _remap_cache.put(key, remap)
+
+
+def prepairholoF(CH_m, xop=None, yop=None, Xp=None, Yp=None, remap=None):
+    """
+    Prepare the hologram using bilinear interpolation, preserving the complex data.
+
+    Parameters:
+    CH_m (2D array, complex): Original hologram matrix.
+    xop, yop (float): Center coordinates of the hologram.
+    Xp, Yp (2D arrays): New coordinates for interpolation.
+    remap (sparse matrix, optional): Precomputed scatter from remap_matrix or
+    geometry_remap, replaces xop, yop, Xp and Yp.
+
+    Returns:
+    CHp_m (2D array, complex): Prepared hologram.
+    """
+    if remap is None:
+        remap = remap_matrix(CH_m.shape, xop, yop, Xp, Yp)
+
+    # A float32 remap keeps single precision holograms in complex64
+    CH_m = np.asarray(CH_m)
+    CHp_m = remap @ CH_m.ravel()
+    CHp_m = CHp_m.astype(np.result_type(remap.dtype, CH_m.dtype, np.complex64), copy=False)
+
+    return CHp_m.reshape(CH_m.shape)
+
+
+class KreuzerPlan:
+    """
+    Precomputed geometry of Kreuzer's method for a fixed set of parameters.
+
+    Everything in kreuzer3F except the hologram itself depends only on
+    (shape, z, L, wavelength, dx, deltaX), so the remap, the weighting of the
+    prepared hologram and the chirp are built once here and applied to any
+    number of frames.
+
+    Parameters:
+    shape (tuple): Hologram shape (rows, cols)
     z (float): Propagation distance
     L (float): Length parameter
     wavelength (float): Wavelength
     dx, deltaX (float): Pixel sizes at different stages
-    FC (2D array): Cosine filter
-
-    Returns:
-    K (2D array): Reconstructed hologram
+    FC_shape (tuple, optional): Shape of the cosine filter, decides the padding
+    dtype (dtype, optional): complex64 for single precision, complex128 otherwise
     """
-    n_rows, n_cols = hologram.shape
-    k = 2 * np.pi / wavelength
-    W = dx * n_cols
-    H = dx * n_rows
 
-    deltaY = deltaX
-    X, Y = np.meshgrid(np.arange(1, n_cols + 1), np.arange(1, n_rows + 1))
+    def __init__(self, shape, z, L, wavelength, dx, deltaX, FC_shape=None, dtype=np.complex128):
+        self.key = (tuple(shape), float(z), float(L), float(wavelength), float(dx), float(deltaX),
+                    tuple(shape) if FC_shape is None else tuple(FC_shape), np.dtype(dtype).str)
+        self.shape = tuple(shape)
+        self.z = z
+        self.L = L
+        self.wavelength = wavelength
+        self.deltaX = deltaX
 
-    xo = -W / 2
-    yo = -H / 2
-    xop = xo * L / np.sqrt(L ** 2 + xo ** 2)
-    yop = yo * L / np.sqrt(L ** 2 + yo ** 2)
+        n_rows, n_cols = shape
+        k = 2 * np.pi / wavelength
+        W = dx * n_cols
+        H = dx * n_rows
 
-    deltaxp = xop / (-n_cols / 2)
-    deltayp = yop / (-n_rows / 2)
-    Xo = -deltaX * n_cols / 2
-    Yo = -deltaY * n_rows / 2
+        deltaY = deltaX
+        X, Y = np.meshgrid(np.arange(1, n_cols + 1), np.arange(1, n_rows + 1))
 
-    Xp = (dx * (X - n_cols / 2) * L) / np.sqrt(L ** 2 + (dx ** 2) * (X - n_cols / 2) ** 2 + (dx ** 2) * (Y - n_rows / 2) ** 2)
-    Yp = (dx * (Y - n_rows / 2) * L) / np.sqrt(L ** 2 + (dx ** 2) * (Y - n_rows / 2) ** 2 + (dx ** 2) * (Y - n_rows / 2) ** 2)
+        xo = -W / 2
+        yo = -H / 2
+        xop = xo * L / np.sqrt(L ** 2 + xo ** 2)
+        yop = yo * L / np.sqrt(L ** 2 + yo ** 2)
 
-    CHp_m = prepairholoF(hologram, xop, yop, Xp, Yp)
+        deltaxp = xop / (-n_cols / 2)
+        deltayp = yop / (-n_rows / 2)
+        Xo = -deltaX * n_cols / 2
+        Yo = -deltaY * n_rows / 2
 
+        self.remap = geometry_remap(shape, L, dx)
+        if np.dtype(dtype) == np.complex64:
+            self.remap = self.remap.astype(np.float32)
 
+        Rp = np.sqrt(L ** 2 - (deltaxp * X + xop) ** 2 - (deltayp * Y + yop) ** 2)
+        r = np.sqrt((deltaY**(2))*(deltaX ** (2)) * ((X - n_cols / 2) ** 2 + (Y - n_rows / 2) ** 2) + z ** 2)
 
-    Rp = np.sqrt(L ** 2 - (deltaxp * X + xop) ** 2 - (deltayp * Y + yop) ** 2)
-    r = np.sqrt((deltaY**(2))*(deltaX ** (2)) * ((X - n_cols / 2) ** 2 + (Y - n_rows / 2) ** 2) + z ** 2)
-    CHp_m *= ((L / Rp) ** 4) * np.exp(-0.5j * k * (r ** 2 - 2 * z * L) * Rp / (L ** 2))
+        # Weighting of the prepared hologram and chirp of T1 merged in a single array
+        self.weights = ((L / Rp) ** 4) * np.exp(-0.5j * k * (r ** 2 - 2 * z * L) * Rp / (L ** 2))
+        self.weights *= np.exp((1j * k / (2 * L)) * (2 * Xo * X * deltaxp + 2 * Yo * Y * deltayp + (X ** 2) * deltaxp * deltaX + (Y ** 2) * deltayp * deltaY))
+        self.weights = self.weights.astype(dtype, copy=False)
 
+        # The padding of T1 follows the shape of the (padded) cosine filter
+        self.pad = n_cols // 2
+        FC_shape = self.key[-2]
+        if FC_shape != self.shape:
+            FC_shape = (FC_shape[0] + 2 * self.pad, FC_shape[1] + 2 * self.pad)
+        self.padded = FC_shape != self.shape
 
+    def matches(self, shape, z, L, wavelength, dx, deltaX, FC_shape=None, dtype=np.complex128):
+        """Returns True if the plan was built for the given parameters."""
+        return self.key == (tuple(shape), float(z), float(L), float(wavelength), float(dx), float(deltaX),
+                            tuple(shape) if FC_shape is None else tuple(FC_shape), np.dtype(dtype).str)
 
-    pad = n_cols // 2
+    def apply(self, hologram):
+        """
+        Reconstructs a hologram with the precomputed geometry.
 
-    # Redimensionar FC si no coincide
-    if FC.shape != CHp_m.shape:
-        FC = np.pad(FC, ((pad, pad), (pad, pad)), mode='constant')
+        Parameters:
+        hologram (2D array): Hologram matrix
+
+        Returns:
+        K (2D array): Reconstructed hologram
+        """
+        n_rows, n_cols = self.shape
+        pad = self.pad
+
+        T1 = prepairholoF(hologram, remap=self.remap)
+        T1 *= self.weights
+
+        if self.padded:
+            T1 = np.pad(T1, ((pad, pad), (pad, pad)), mode='constant')
+
+        K = propagate(T1, (self.L-self.z), self.wavelength, self.deltaX, self.deltaX)
+        K = K[pad:pad + n_rows, pad:pad + n_rows]
+        K = np.abs(K) ** 2
+        K = normalize(K)
+
+        return K
+
+
+# Last plan used by kreuzer3F, rebuilt whenever any of its parameters change
+_last_plan = [None]
+
+def kreuzer_plan(shape, z, L, wavelength, dx, deltaX, FC_shape=None, dtype=np.complex128):
+    """
+    Returns a KreuzerPlan for the given parameters, reusing the last one if possible.
+
+    Changing any parameter (e.g. moving the L/Z sliders of the GUI) invalidates
+    the previous plan and builds a new one.
+    """
+    plan = _last_plan[0]
 
+    if plan is None or not plan.matches(shape, z, L, wavelength, dx, deltaX, FC_shape, dtype):
+        plan = KreuzerPlan(shape, z, L, wavelength, dx, deltaX, FC_shape, dtype)
+        _last_plan[0] = plan
 
-    T1 = CHp_m * np.exp((1j * k / (2 * L)) * (2 * Xo * X * deltaxp + 2 * Yo * Y * deltayp + (X ** 2) * deltaxp * deltaX + (Y ** 2) * deltayp * deltaY))
+    return plan
 
-    # Asegurarse de que la matriz T1 también se redimensione correctamente
-    if T1.shape != FC.shape:
-        T1 = np.pad(T1, ((pad, pad), (pad, pad)), mode='constant')
 
-    K = propagate(T1, (L-z), wavelength, deltaX, deltaY)
-    K = K[pad:pad + n_rows, pad:pad + n_rows]
-    K = np.abs(K) ** 2
-    K = normalize(K)
+def kreuzer3F(hologram, z, L, wavelength, dx, deltaX, FC):
+    """
+    Reconstructs an in-line hologram using Kreuzer's method.
+
+    Parameters:
+    hologram (2D array): Hologram matrix
+    z (float): Propagation distance
+    L (float): Length parameter
+    wavelength (float): Wavelength
+    dx, deltaX (float): Pixel sizes at different stages
+    FC (2D array): Cosine filter
+
+    Returns:
+    K (2D array): Reconstructed hologram, float32 for float32/complex64 holograms
+    """
+    plan = kreuzer_plan(hologram.shape, z, L, wavelength, dx, deltaX, FC.shape,
+                        complex_dtype(np.asarray(hologram).dtype))
 
-    return K
\ No newline at end of file
+    return plan.apply(hologram)
@@ -7,6 +7,7 @@ from multiprocessing import Process, Queue
 from settings import *
 from _3DHR_Utilities import *
 from parallel_rc import *
+from stage_timing import format_summary
 class App(ctk.CTk):
     def __init__(self):
         super().__init__()
@@ -41,6 +42,9 @@ class App(ctk.CTk):
         self.dxy = DEFAULT_DXY #Microns
         self.scale_factor = self.L/self.Z#
 
+        # Precision of the reconstructions, float32 halves memory traffic and FFT cost
+        self.precision = RECONSTRUCTION_PRECISION
+
         # FC parameter setting
         self.cosine_period = DEFAULT_COSINE_PERIOD
 
@@ -105,6 +109,10 @@ class App(ctk.CTk):
         self.c_fps = 0
         self.r_fps = 0
 
+        # Rolling p50/p95 of each stage of the workers, None unless STAGE_TIMING is set
+        self.c_timings = None
+        self.r_timings = None
+
         self.max_w_fps = 0
 
         self.settings = False
@@ -122,12 +130,13 @@ class App(ctk.CTk):
         
         self.capture_input = {'path': None, 'reference path': None, 'settings': None, 'filters': None, 'filter': None}
 
-        self.capture_output = {'image': None, 'filtered': None, 'fps': 0, 'size': (0, 0)}
+        self.capture_output = {'image': None, 'filtered': None, 'fps': 0, 'size': (0, 0), 'timings': None}
 
         self.recon_input = {'image': None, 'filters': None, 'filter': False, 'algorithm': None, 'L': 0, 'Z': 0, 'r': 0, 
-                            'wavelength': 0, 'dxy': 0, 'scale_factor': 0, 'squared': False, 'phase': False}
+                            'wavelength': 0, 'dxy': 0, 'scale_factor': 0, 'squared': False, 'phase': False,
+                            'precision': RECONSTRUCTION_PRECISION, 'cosine_period': DEFAULT_COSINE_PERIOD}
         
-        self.recon_output = {'image': None, 'filtered': None, 'fps': 0}
+        self.recon_output = {'image': None, 'filtered': None, 'fps': 0, 'timings': None}
 
         
         self.update_inputs()
@@ -164,18 +173,22 @@ class App(ctk.CTk):
             self.recon_input['scale_factor'] = self.scale_factor
             self.recon_input['squared'] = self.square_field.get()
             self.recon_input['phase'] = self.phase_r.get()
+            self.recon_input['precision'] = self.precision
+            self.recon_input['cosine_period'] = self.cosine_period
 
     def update_outputs(self, process:str = ''):
         if process=='capture' or not process:
             self.arr_c = self.capture_output['image']
             self.img_c = self.capture_output['filtered']
             self.c_fps = self.capture_output['fps']
+            self.c_timings = self.capture_output['timings']
             self.width, self.height = self.capture_output['size']
 
         if process=='reconstruction' or not process:
             self.arr_r = self.recon_output['image'] 
             self.img_r = self.recon_output['filtered'] 
             self.r_fps = self.recon_output['fps'] 
+            self.r_timings = self.recon_output['timings']
 
     def init_viewing_frame(self):
         # Frame for navigation
@@ -266,6 +279,13 @@ class App(ctk.CTk):
         # For displaying frames per second (actual real life time, not tick time)
         self.r_fps_label = ctk.CTkLabel(self.image_frame, text=f'FPS: {self.r_fps}')
         self.r_fps_label.grid(row=2, column=1, padx=20, pady=20)
+
+        # Per-stage timings of each worker
+        if STAGE_TIMING:
+            self.c_timings_label = ctk.CTkLabel(self.image_frame, text='', justify='left')
+            self.c_timings_label.grid(row=3, column=0, padx=20, pady=(0, 20))
+            self.r_timings_label = ctk.CTkLabel(self.image_frame, text='', justify='left')
+            self.r_timings_label.grid(row=3, column=1, padx=20, pady=(0, 20))
         
         # Buttons for saving and changing image scale
 
@@ -1097,6 +1117,10 @@ class App(ctk.CTk):
         self.c_fps_label.configure(text=f'FPS: {self.c_fps}')
         self.r_fps_label.configure(text=f'FPS: {self.r_fps}')
 
+        if STAGE_TIMING:
+            self.c_timings_label.configure(text=format_summary(self.c_timings))
+            self.r_timings_label.configure(text=format_summary(self.r_timings))
+
         self.after(15, self.draw)
 
     def check_current_FC(self):
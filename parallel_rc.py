@@ -7,17 +7,11 @@ from skimage import exposure, filters
 
 from settings import *
 from _3DHR_Utilities import *
+from reconstruction import im2arr, arr2im, reconstruct_frame
+from stage_timing import stage_timer
 
 
 
-def im2arr(path: str):
-    '''Converts file image into numpy array.'''
-    return np.asarray(Image.open(path).convert('L'))
-
-def arr2im(array: np.ndarray):
-    '''Converts numpy array into PhotoImage type'''
-    return Image.fromarray(array.astype(np.uint8), 'L')
-
 def create_image(img: Image.Image, width, height):
     '''Converts image into type usable by customtkinter'''
     return CTkImage(light_image=img, dark_image=img, size=(width, height))
@@ -28,16 +22,20 @@ def gamma_filter(arr, gamma):
 def contrast_filter(arr, contrast):
     return np.uint8(np.clip(arr * contrast, 0, 255))
 
+def _filter_dtype(arr):
+    '''Float32 images are filtered in single precision, everything else in double.'''
+    return np.float32 if arr.dtype == np.float32 else np.float64
+
 def adaptative_eq_filter(arr, _):
-    arr = exposure.equalize_adapthist(normalize(arr, 1), clip_limit=DEFAULT_CLIP_LIMIT)
+    arr = exposure.equalize_adapthist(normalize(arr, 1, _filter_dtype(arr)), clip_limit=DEFAULT_CLIP_LIMIT)
     return np.uint8(arr * 255)  # Convertir de 0-1 a 0-255
 
 def highpass_filter(arr, freq):
-    arr = filters.butterworth(normalize(arr, 1), freq, high_pass=True)
+    arr = filters.butterworth(normalize(arr, 1, _filter_dtype(arr)), freq, high_pass=True)
     return np.uint8(arr*255)
 
 def lowpass_filter(arr, freq):
-    arr = filters.butterworth(normalize(arr, 1), freq, high_pass=False)
+    arr = filters.butterworth(normalize(arr, 1, _filter_dtype(arr)), freq, high_pass=False)
     return np.uint8(arr*255)
 
 def capture(queue_manager:dict[dict[Queue, Queue], dict[Queue, Queue], dict[Queue, Queue]]):
@@ -57,7 +55,11 @@ def capture(queue_manager:dict[dict[Queue, Queue], dict[Queue, Queue], dict[Queu
     output_dict = {'image':None,
                    'filtered':None,
                    'fps':None,
-                   'size':None}
+                   'size':None,
+                   'timings':None}
+
+    # Per-stage durations, a no-op unless STAGE_TIMING is set in settings.py
+    timer = stage_timer(('grab', 'flip', 'reference', 'filters', 'CTkImage'))
 
     # Initialize camera (0 by default most of the time means the integrated camera)
     cap = cv2.VideoCapture(0, cv2.CAP_DSHOW)
@@ -80,9 +82,12 @@ def capture(queue_manager:dict[dict[Queue, Queue], dict[Queue, Queue], dict[Queu
 
     while True:
         init_time = time.time()
+        timer.start()
         # Captura la imagen de la cámara
         img = cv2.cvtColor(cap.read()[1], cv2.COLOR_BGR2GRAY)
+        timer.mark('grab')
         img = cv2.flip(img, 1)  # Voltea horizontalmente
+        timer.mark('flip')
 
         filt_img = img
 
@@ -94,6 +99,8 @@ def capture(queue_manager:dict[dict[Queue, Queue], dict[Queue, Queue], dict[Queu
             for key in input_dict.keys():
                 input_dict[key] = input[key]
 
+        timer.skip()
+
         if input_dict['path']:
             img = im2arr(input_dict['path'])
             filt_img = img
@@ -101,6 +108,8 @@ def capture(queue_manager:dict[dict[Queue, Queue], dict[Queue, Queue], dict[Queu
             # Gets the actual resolution of the image
             height_, width_ = img.shape
 
+            timer.mark('grab')
+
         if input_dict['reference path']:
             ref = im2arr(input_dict['reference path'])
             if img.shape == ref.shape:
@@ -110,8 +119,12 @@ def capture(queue_manager:dict[dict[Queue, Queue], dict[Queue, Queue], dict[Queu
             
             filt_img = img
 
+        timer.mark('reference')
+
         if input_dict['settings']:
             open_camera_settings(cap)
+
+        timer.skip()
         
         if input_dict['filters']:
             filter_functions = input_dict['filters'][0]
@@ -120,10 +133,14 @@ def capture(queue_manager:dict[dict[Queue, Queue], dict[Queue, Queue], dict[Queu
             if input_dict['filter']:
                 for filter, param, in zip(filter_functions, filter_params):
                     filt_img = filter_dict[filter](filt_img, param)
+
+        timer.mark('filters')
         
         filt_img = arr2im(filt_img.astype(np.uint8))
         filt_img = create_image(filt_img, width_, height_)
 
+        timer.mark('CTkImage')
+        timer.end()
 
         end_time = time.time()
 
@@ -136,6 +153,7 @@ def capture(queue_manager:dict[dict[Queue, Queue], dict[Queue, Queue], dict[Queu
             output_dict['filtered'] = filt_img
             output_dict['fps'] = fps
             output_dict['size'] = (width_, height_)
+            output_dict['timings'] = timer.summary()
 
             queue_manager['capture']['output'].put(output_dict)
 
@@ -164,13 +182,19 @@ def reconstruct(queue_manager:dict[dict[Queue, Queue], dict[Queue, Queue], dict[
                   'dxy':None,
                   'scale_factor':None,
                   'squared':None,
-                  'phase':None
+                  'phase':None,
+                  'precision':None,
+                  'cosine_period':None
                   }
     
     output_dict = {'image':None,
                    'filtered':None,
-                   'fps':None
+                   'fps':None,
+                   'timings':None
                    }
+
+    # Per-stage durations, a no-op unless STAGE_TIMING is set in settings.py
+    timer = stage_timer(('normalize', 'filtcosenoF', 'algorithm', 'magnitude/phase', 'filters', 'CTkImage'))
     while True:
         if not queue_manager['reconstruction']['input'].empty():
             # We want this processing to ocurr only if there is an image to process
@@ -182,35 +206,21 @@ def reconstruct(queue_manager:dict[dict[Queue, Queue], dict[Queue, Queue], dict[
             for key in input_dict.keys():
                 input_dict[key] = input[key]
 
-            field = np.sqrt(normalize(input_dict['image'], 1))
-
-            FC = filtcosenoF(DEFAULT_COSINE_PERIOD, np.array((field.shape[1], field.shape[0])))
-
-            if input_dict['algorithm'] == 'AS':
-                recon = propagate(field, 
-                                  input_dict['r'], 
-                                  input_dict['wavelength'], 
-                                  input_dict['dxy'], 
-                                  input_dict['dxy'], 
-                                  input_dict['scale_factor'])
-            elif input_dict['algorithm'] == 'KR':
-
-                Z = input_dict['Z']
-                L = input_dict['L']
-                dxy = input_dict['dxy']
-
-                deltaX = Z*dxy/L
-                recon = kreuzer3F(field, Z, L, input_dict['wavelength'], dxy, deltaX, FC)
-
-            sq = input_dict['squared']
-            ph = input_dict['phase']
-
-            if sq:
-                arr = normalize(np.abs(recon)**2,255)
-            elif not sq and ph:
-                arr = normalize(np.angle(recon),255)
-            else:
-                arr = normalize(np.abs(recon),255)
+            timer.start()
+
+            recon, arr = reconstruct_frame(input_dict['image'],
+                                           input_dict['algorithm'],
+                                           input_dict['L'],
+                                           input_dict['Z'],
+                                           input_dict['r'],
+                                           input_dict['wavelength'],
+                                           input_dict['dxy'],
+                                           input_dict['scale_factor'],
+                                           input_dict['squared'],
+                                           input_dict['phase'],
+                                           input_dict['precision'] or RECONSTRUCTION_PRECISION,
+                                           timer,
+                                           input_dict['cosine_period'] or DEFAULT_COSINE_PERIOD)
 
             filt_img = arr
 
@@ -222,9 +232,13 @@ def reconstruct(queue_manager:dict[dict[Queue, Queue], dict[Queue, Queue], dict[
                     for filter, param, in zip(filter_functions, filter_params):
                         filt_img = filter_dict[filter](filt_img, param)
 
+            timer.mark('filters')
 
             filt_img = arr2im(filt_img.astype(np.uint8))
-            filt_img = create_image(filt_img, field.shape[1], field.shape[0])
+            filt_img = create_image(filt_img, arr.shape[1], arr.shape[0])
+
+            timer.mark('CTkImage')
+            timer.end()
 
             end_time = time.time()
             elapsed_time = end_time-init_time
@@ -235,5 +249,6 @@ def reconstruct(queue_manager:dict[dict[Queue, Queue], dict[Queue, Queue], dict[
                 output_dict['image']= arr
                 output_dict['filtered']=filt_img
                 output_dict['fps'] = fps
+                output_dict['timings'] = timer.summary()
 
                 queue_manager['reconstruction']['output'].put(output_dict)
\ No newline at end of file
@@ -0,0 +1,73 @@
+'''
+    Run this file to compare the single precision (float32/complex64) reconstruction
+    against the double precision one on a hologram, by default references/test_image.bmp
+
+    python precision_report.py [image] [L] [Z]
+'''
+
+import sys
+import time
+import numpy as np
+import cv2
+
+from settings import *
+from reconstruction import reconstruct_frame
+
+
+def reconstruct_display(image, algorithm, L, Z, wavelength, dxy, precision):
+    '''Reconstructs like parallel_rc.reconstruct and returns the (complex, 0-255) images.'''
+    return reconstruct_frame(image, algorithm, L, Z, L-Z, wavelength, dxy, L/Z,
+                             precision=precision)
+
+
+def precision_report(image, L=INIT_L, Z=INIT_Z, wavelength=DEFAULT_WAVELENGTH, dxy=DEFAULT_DXY) -> dict:
+    '''Returns the errors of the float32 path against the float64 path for AS and KR.
+
+    For each algorithm: dtype of the result, maximum and relative RMS error of the
+    complex field, maximum error and PSNR of the 8 bit display image, fraction of
+    display pixels that differ after uint8 conversion and the time of both paths.
+    '''
+    report = {}
+
+    for algorithm in ('AS', 'KR'):
+        times = {}
+        results = {}
+
+        for precision in ('float64', 'float32'):
+            # First call builds the cached kernels, the second one is timed
+            reconstruct_display(image, algorithm, L, Z, wavelength, dxy, precision)
+            init_time = time.time()
+            results[precision] = reconstruct_display(image, algorithm, L, Z, wavelength, dxy, precision)
+            times[precision] = time.time()-init_time
+
+        field64, disp64 = results['float64']
+        field32, disp32 = results['float32']
+
+        field_err = np.abs(field32.astype(field64.dtype)-field64)
+        disp_err = np.abs(disp32.astype(np.float64)-disp64)
+        mse = np.mean(disp_err**2)
+
+        report[algorithm] = {'dtype': str(field32.dtype),
+                             'field_max_abs_error': float(np.max(field_err)),
+                             'field_relative_rms_error': float(np.sqrt(np.mean(field_err**2)/np.mean(np.abs(field64)**2))),
+                             'display_max_abs_error': float(np.max(disp_err)),
+                             'display_psnr_db': float(10*np.log10(255**2/mse)) if mse!=0 else float('inf'),
+                             'display_uint8_mismatch': float(np.mean(disp32.astype(np.uint8)!=disp64.astype(np.uint8))),
+                             'time_float64_s': times['float64'],
+                             'time_float32_s': times['float32']}
+
+    return report
+
+
+if __name__ == '__main__':
+    path = sys.argv[1] if len(sys.argv) > 1 else 'references/test_image.bmp'
+    L = float(sys.argv[2]) if len(sys.argv) > 2 else INIT_L
+    Z = float(sys.argv[3]) if len(sys.argv) > 3 else INIT_Z
+
+    image = cv2.imread(path, cv2.IMREAD_GRAYSCALE)
+
+    print(f'Image: {path} {image.shape}, L={L} um, Z={Z} um')
+    for algorithm, values in precision_report(image, L, Z).items():
+        print(f'\n{algorithm}')
+        for key, value in values.items():
+            print(f'    {key}: {value}')
@@ -0,0 +1,71 @@
+'''Reconstruction of a single frame, shared by the GUI worker and the batch tools.
+
+Nothing here depends on customtkinter, so it can be used headless.
+'''
+
+import numpy as np
+from PIL import Image
+
+from settings import *
+from _3DHR_Utilities import normalize, precision_dtypes, propagate
+from kreuzer_functions import kreuzer3F, cosine_filter
+from stage_timing import NULL_TIMER
+
+
+def im2arr(path: str):
+    '''Converts file image into numpy array.'''
+    return np.asarray(Image.open(path).convert('L'))
+
+def arr2im(array: np.ndarray):
+    '''Converts numpy array into PhotoImage type'''
+    return Image.fromarray(array.astype(np.uint8), 'L')
+
+def reconstruct_frame(image: np.ndarray,
+                      algorithm: str,
+                      L: float,
+                      Z: float,
+                      r: float,
+                      wavelength: float,
+                      dxy: float,
+                      scale_factor: float,
+                      squared: bool = False,
+                      phase: bool = False,
+                      precision: str = RECONSTRUCTION_PRECISION,
+                      timer = NULL_TIMER,
+                      cosine_period: float = DEFAULT_COSINE_PERIOD) -> tuple[np.ndarray, np.ndarray]:
+    '''Reconstructs a hologram with the angular spectrum ('AS') or Kreuzer ('KR') method.
+
+    Returns the complex (or KR intensity) reconstruction and the 0-255 image shown
+    for it: intensity if squared, phase if phase, amplitude otherwise. The cosine
+    filter of cosine_period is only rebuilt when the period or frame size change. The stages
+    'normalize', 'filtcosenoF', 'algorithm' and 'magnitude/phase' are marked on timer
+    (see stage_timing).
+    '''
+    real_type, _ = precision_dtypes(precision)
+
+    field = np.sqrt(normalize(image, 1, real_type))
+    timer.mark('normalize')
+
+    FC = cosine_filter(cosine_period, (field.shape[1], field.shape[0]), real_type)
+    timer.mark('filtcosenoF')
+
+    if algorithm == 'AS':
+        recon = propagate(field, r, wavelength, dxy, dxy, scale_factor)
+    elif algorithm == 'KR':
+        deltaX = Z*dxy/L
+        recon = kreuzer3F(field, Z, L, wavelength, dxy, deltaX, FC)
+    else:
+        raise ValueError(f'Unknown algorithm: {algorithm}')
+
+    timer.mark('algorithm')
+
+    if squared:
+        arr = normalize(np.abs(recon)**2,255, real_type)
+    elif not squared and phase:
+        arr = normalize(np.angle(recon),255, real_type)
+    else:
+        arr = normalize(np.abs(recon),255, real_type)
+
+    timer.mark('magnitude/phase')
+
+    return recon, arr
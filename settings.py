@@ -11,6 +11,33 @@ MAX_HEIGHT = 1080
 
 DEFAULT_COSINE_PERIOD = 2
 
+# Number of angular spectrum transfer functions kept in memory by propagate and ang_spectrum
+TRANSFER_CACHE_SIZE = 8
+
+# Number of Kreuzer remap matrices (one per hologram geometry) kept in memory
+REMAP_CACHE_SIZE = 2
+
+# Number of cosine filters (one per period and frame size) kept in memory
+FILTER_CACHE_SIZE = 4
+
+# Number of off-axis quadrant masks (one per frame size and region) kept by filter_mask
+MASK_CACHE_SIZE = 16
+
+# FFT backend used by every transform: 'scipy', 'pyfftw' (optional) or 'numpy'
+FFT_BACKEND = 'scipy'
+FFT_WORKERS = -1 # -1 uses every core
+FFTW_WISDOM_PATH = 'fftw_wisdom.pkl' # Persisted pyFFTW plans
+
+# Precision of the live reconstruction: 'float64' (complex128) or 'float32' (complex64)
+RECONSTRUCTION_PRECISION = 'float64'
+
+# Memory (bytes) propagate_tiled may use for holograms that do not fit in RAM
+TILED_MEMORY_BUDGET = 2*1024**3
+
+# Per-stage timing of the capture and reconstruction workers (rolling p50/p95 in the GUI)
+STAGE_TIMING = False
+STAGE_TIMING_FRAMES = 120 # Frames kept for the percentiles
+
 INIT_MIN_L = 0 # MICRONS
 INIT_MAX_L = 20000 # MICRONS
 INIT_L = INIT_MAX_L/2
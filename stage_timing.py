@@ -0,0 +1,94 @@
+'''Per-stage timing of the frames processed by the capture and reconstruction workers.
+
+    timer = stage_timer(('grab', 'flip'))
+    timer.start()
+    ...
+    timer.mark('grab')
+    ...
+    timer.mark('flip')
+    timer.end()
+    timer.summary()  # {'grab': (p50_ms, p95_ms), 'flip': (p50_ms, p95_ms)}
+
+With STAGE_TIMING off in settings.py stage_timer returns NULL_TIMER, whose methods
+do nothing, so the instrumented code runs no timing code at all.
+'''
+
+import time
+import numpy as np
+
+from settings import STAGE_TIMING, STAGE_TIMING_FRAMES
+
+
+class StageTimer:
+    '''Keeps the duration of every stage for the last frames in a ring buffer.'''
+
+    def __init__(self, stages, frames: int = STAGE_TIMING_FRAMES):
+        self.stages = list(stages)
+        self.index = {stage: i for i, stage in enumerate(self.stages)}
+        self.buffer = np.zeros((frames, len(self.stages)))
+        self.count = 0
+        self.last = 0
+        self.row = self.buffer[0]
+
+    def start(self):
+        '''Starts a new frame, overwriting the oldest one.'''
+        self.row = self.buffer[self.count % len(self.buffer)]
+        self.row[:] = 0
+        self.last = time.perf_counter()
+
+    def mark(self, stage: str):
+        '''Adds the time since the last mark (or start) to a stage of the current frame.'''
+        now = time.perf_counter()
+        self.row[self.index[stage]] += now - self.last
+        self.last = now
+
+    def skip(self):
+        '''Restarts the clock without charging the elapsed time to any stage.'''
+        self.last = time.perf_counter()
+
+    def end(self):
+        '''Closes the current frame.'''
+        self.count += 1
+
+    def summary(self) -> dict:
+        '''Rolling p50 and p95 of each stage in milliseconds.'''
+        frames = self.buffer[:min(self.count, len(self.buffer))]
+        if len(frames) == 0:
+            return {}
+
+        p50, p95 = np.percentile(frames, (50, 95), axis=0)*1e3
+        return {stage: (p50[i], p95[i]) for i, stage in enumerate(self.stages)}
+
+
+class _NullTimer:
+    '''Stand-in used when timing is off.'''
+
+    def start(self):
+        pass
+
+    def mark(self, stage: str):
+        pass
+
+    def skip(self):
+        pass
+
+    def end(self):
+        pass
+
+    def summary(self):
+        return None
+
+
+NULL_TIMER = _NullTimer()
+
+
+def stage_timer(stages, enabled: bool = STAGE_TIMING):
+    '''Returns a StageTimer for the stages, or NULL_TIMER if timing is disabled.'''
+    return StageTimer(stages) if enabled else NULL_TIMER
+
+
+def format_summary(summary) -> str:
+    '''Text for the GUI, one "stage p50/p95 ms" line per stage.'''
+    if not summary:
+        return ''
+    return '\n'.join(f'{stage}: {p50:.1f} / {p95:.1f} ms' for stage, (p50, p95) in summary.items())